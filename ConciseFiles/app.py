@@ -1,21 +1,41 @@
 # app.py
+import time
+
+# Cold-start clock: everything below, including imports, counts
+_process_started = time.perf_counter()
+
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-import yt_dlp
 import aiofiles
 import asyncio
-import io
-from datetime import datetime, timedelta
 import humanize
-from typing import Optional, Callable, TypeVar, ParamSpec, Dict
+from typing import Optional, Callable, TypeVar, ParamSpec, Dict, Tuple
 from fastapi.requests import Request
 from functools import wraps
-import time
+import logging
+
+from extraction import ExtractionFailure, classify_error, extraction_service
+from formats import (
+    DOWNLOAD_MAX_BYTES, byte_budget, demuxed_ext, describe_merge, estimated_size, merged_ext, merged_size,
+    select_audio, select_format, select_merge, wants_save_data, within_cap,
+)
+from fragments import fragment_stats, stream_fragments
+from media import FRAGMENTED_PROTOCOLS, Format, MediaRecord
+from remux import remuxer
+from cache import TTLCache, create_cache
+from singleflight import SingleFlight
+from streaming import segment_stats, stream_upstream, upstream_pool
+from tokens import InvalidToken, download_tokens
+from urls import canonical_key, extractor_key
+
+_import_seconds = time.perf_counter() - _process_started
+
+logger = logging.getLogger("uvicorn.error")
 
 # Initialize FastAPI
 app = FastAPI()
@@ -53,86 +73,175 @@ async def add_cache_headers(request: Request, call_next):
     
     return response
 
-# Simple in-memory cache with size limit
+# In-memory LRU cache with per-entry expiry (L1), in front of Redis (L2)
+# when REDIS_URL is set so all workers share results
 MAX_CACHE_ITEMS = 100
-cache: Dict[str, tuple[any, datetime]] = {}
+cache = create_cache(TTLCache(maxsize=MAX_CACHE_ITEMS))
+
+# Resolved direct media URLs, kept apart from metadata because each one
+# expires on its own schedule (the CDN signature), minus a safety margin
+MEDIA_URL_CACHE_ITEMS = 500
+MEDIA_URL_EXPIRY_MARGIN = 300
+MEDIA_URL_DEFAULT_TTL = 600
+media_url_cache = create_cache(TTLCache(maxsize=MEDIA_URL_CACHE_ITEMS), l2=cache.l2)
+
+# Only one extraction per URL in flight at a time, across all workers when
+# Redis is available; everyone else waits for and shares its result
+# Failures travel as their category, so waiters in other workers cache and
+# report them exactly like the leader; transient ones (TTL 0) are not kept
+# for late waiters
+extraction_flight = SingleFlight(
+    cache.l2,
+    encode=MediaRecord.to_dict,
+    decode=MediaRecord.from_dict,
+    encode_error=lambda e: classify_error(e).to_dict(),
+    decode_error=ExtractionFailure.from_dict,
+    retain_error=lambda e: classify_error(e).ttl > 0,
+)
+
+# Recent extraction failures (private, deleted, unsupported...) per URL, so
+# retries of a dead link are answered without another yt-dlp round trip
+NEGATIVE_CACHE_ITEMS = 1000
+negative_cache = TTLCache(maxsize=NEGATIVE_CACHE_ITEMS)
+negative_cache_hits_by_category: Dict[str, int] = {}
 
 # Cache cleanup function
 async def cleanup_old_cache():
     while True:
         try:
-            now = datetime.now()
-            expired_keys = [
-                k for k, v in cache.items() 
-                if now - v[1] > timedelta(minutes=5)
-            ]
-            for k in expired_keys:
-                del cache[k]
-            
-            # Keep cache size in check
-            if len(cache) > MAX_CACHE_ITEMS:
-                oldest_keys = sorted(
-                    cache.keys(), 
-                    key=lambda k: cache[k][1]
-                )[:len(cache) - MAX_CACHE_ITEMS]
-                for k in oldest_keys:
-                    del cache[k]
-                    
+            cache.l1.purge_expired()
+            media_url_cache.l1.purge_expired()
+            negative_cache.purge_expired()
         except Exception:
             pass
         await asyncio.sleep(300)  # Run every 5 minutes
 
+# Seconds from import to serving pages, and to extraction being warm
+cold_start: Dict[str, Optional[float]] = {'import_s': round(_import_seconds, 3), 'serving_s': None, 'ready_s': None}
+
+async def report_cold_start(serving_s: float):
+    cold_start['serving_s'] = round(serving_s, 3)
+    await extraction_service.wait_ready()
+    cold_start['ready_s'] = round(time.perf_counter() - _process_started, 3)
+    logger.info(
+        "Cold start: serving after %.2fs, extraction warm after %.2fs (warm-up %.2fs)",
+        serving_s, cold_start['ready_s'], extraction_service.warm_up_seconds,
+    )
+
 @app.on_event("startup")
 async def startup_event():
+    await extraction_service.start()
+    await upstream_pool.start()
+    await cache.start()
+    await media_url_cache.start()
+    await download_tokens.start(cache.l2)
     asyncio.create_task(cleanup_old_cache())
+    asyncio.create_task(report_cold_start(time.perf_counter() - _process_started))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    extraction_service.shutdown()
+    await upstream_pool.close()
+    await cache.close()
+    await media_url_cache.close()
 
 class VideoURL(BaseModel):
     url: str
+    # One of the format_ids listed by /video-info; default is the best muxed one
+    format_id: Optional[str] = None
 
 T = TypeVar('T')
 P = ParamSpec('P')
 
-def cache_response(expire_time: int = 300) -> Callable[[Callable[P, T]], Callable[P, T]]:
+def cache_response(
+    expire_time: int = 300,
+    stale_time: int = 600,
+    key: Optional[Callable[..., str]] = None,
+) -> Callable[[Callable[P, T]], Callable[P, T]]:
     def decorator(func: Callable[P, T]) -> Callable[P, T]:
         @wraps(func)
         async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-            cache_key = f"{func.__name__}:{str(args)}:{str(kwargs)}"
-            
-            # Check cache
-            if cache_key in cache:
-                cached_value, timestamp = cache[cache_key]
-                if datetime.now() - timestamp < timedelta(seconds=expire_time):
-                    return cached_value
-                else:
-                    del cache[cache_key]
+            if key is not None:
+                cache_key = f"{func.__name__}:{key(*args, **kwargs)}"
+            else:
+                cache_key = f"{func.__name__}:{str(args)}:{str(kwargs)}"
             
-            response = await func(*args, **kwargs)
-            
-            # Only cache if we haven't exceeded the limit
-            if len(cache) < MAX_CACHE_ITEMS:
-                cache[cache_key] = (response, datetime.now())
-            return response
+            # Fresh for expire_time, then served stale for up to stale_time
+            # more while a background task refreshes it
+            return await cache.get_or_load(
+                cache_key,
+                lambda: func(*args, **kwargs),
+                ttl=expire_time,
+                stale_ttl=stale_time,
+            )
         return wrapper
     return decorator
 
+# Longest video we allow, in seconds
+MAX_DURATION = 120
+
 class VideoProcessor:
     def __init__(self, url: str):
-        self.url = url
+        self.url = url.strip()
+        # Same key for every link shape of one post, e.g. youtu.be/ID and /shorts/ID
+        self.key = canonical_key(self.url)
+        # None for links outside Instagram, Facebook and YouTube
+        self.extractor = extractor_key(self.url)
         self.ydl_opts = {
             'quiet': True,
             'format': 'best',
             'no_warnings': True,
             'socket_timeout': 10,  # Timeout for network operations
         }
+        # Extraction result memoized for the lifetime of this processor, so the
+        # duration check, metadata and direct URL all share one yt-dlp round trip
+        self._info: Optional[MediaRecord] = None
+        self._info_lock = asyncio.Lock()
     
-    async def get_info(self) -> dict:
-        with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-            return await asyncio.to_thread(ydl.extract_info, self.url, download=False)
+    async def get_info(self) -> MediaRecord:
+        async with self._info_lock:
+            if self._info is None:
+                if self.extractor is None:
+                    raise ExtractionFailure(
+                        "unsupported", "Only Instagram, Facebook and YouTube video links are supported"
+                    )
+                failure = negative_cache.get(self.key)
+                if failure is not None:
+                    category, message = failure
+                    negative_cache_hits_by_category[category] = negative_cache_hits_by_category.get(category, 0) + 1
+                    raise ExtractionFailure(category, message)
+                try:
+                    self._info = await extraction_flight.do(
+                        self.key,
+                        lambda: extraction_service.extract(self.url, self.ydl_opts, self.extractor),
+                    )
+                except Exception as e:
+                    failure = classify_error(e)
+                    if failure.ttl:
+                        negative_cache.put(self.key, (failure.category, failure.message), ttl=failure.ttl)
+                    raise failure from e
+            return self._info
     
-    async def is_duration_valid(self, max_duration: int = 120) -> bool:
+    async def get_media(self) -> MediaRecord:
+        # Same record, but straight from the media URL cache when an earlier
+        # request already resolved this post and its direct URL still works
+        cached = await media_url_cache.get(f"media:{self.key}")
+        if cached is not None:
+            return MediaRecord.from_dict(cached)
+
+        media = await self.get_info()
+        if media.expires_at is None:
+            ttl = MEDIA_URL_DEFAULT_TTL
+        else:
+            ttl = media.expires_at - time.time() - MEDIA_URL_EXPIRY_MARGIN
+        if media.url and ttl > 0:
+            await media_url_cache.set(f"media:{self.key}", media.to_dict(), ttl=ttl)
+        return media
+
+    async def is_duration_valid(self, max_duration: int = MAX_DURATION) -> bool:
         try:
             info = await self.get_info()
-            return info.get("duration", 0) <= max_duration
+            return info.duration <= max_duration
         except Exception:
             return False
 
@@ -168,69 +277,220 @@ async def about(request: Request):
 async def privacy(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "section": "privacy-section"})
 
+@app.get("/ready")
+async def ready():
+    # Readiness probe: 503 until the extraction warm-up has run; a failed
+    # warm-up only means extractions load what they need on first use
+    if not extraction_service.ready:
+        return JSONResponse({'ready': False}, status_code=503)
+    return {'ready': True}
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        'cold_start': cold_start,
+        'cache': cache.stats(),
+        'negative_cache': {
+            **negative_cache.stats(),
+            'hits_by_category': dict(negative_cache_hits_by_category),
+        },
+        'media_url_cache': media_url_cache.stats(),
+        'extraction': extraction_service.stats(),
+        'extraction_flight': extraction_flight.stats(),
+        'download_tokens': download_tokens.stats(),
+        'upstream_pool': upstream_pool.stats(),
+        'segmented_downloads': dict(segment_stats),
+        'fragmented_downloads': dict(fragment_stats),
+        'remux': remuxer.stats(),
+    }
+
+def pick_download(media: MediaRecord, save_data: bool) -> Optional[Format]:
+    # Rendition to serve when the client did not choose one: the best that
+    # fits the byte budget. None means the record's own url, which is only
+    # used when yt-dlp listed no usable formats at all
+    fmt = select_format(media, byte_budget(save_data))
+    if fmt is None:
+        too_large = any(f.muxed for f in media.usable_formats()) or (media.filesize or 0) > DOWNLOAD_MAX_BYTES
+        if too_large:
+            raise HTTPException(status_code=413, detail="This video is too large to download")
+    return fmt
+
+def pick_merge(media: MediaRecord, format_id: str, save_data: bool) -> Tuple[Format, Format]:
+    # "<video>+<audio>" as listed by /video-info, or yt-dlp's own
+    # "bestvideo+bestaudio" for the best pair within the byte budget
+    if format_id == "bestvideo+bestaudio":
+        pair = select_merge(media, byte_budget(save_data))
+    else:
+        video_id, _, audio_id = format_id.partition("+")
+        pair = (media.get_format(video_id), media.get_format(audio_id))
+        if None in pair or not pair[0].has_video or not pair[1].has_audio:
+            pair = None
+    if pair is None:
+        raise HTTPException(status_code=404, detail="Requested format is not available")
+    size = merged_size(*pair, media.duration)
+    if size is not None and size > DOWNLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="This video is too large to download")
+    return pair
+
+def pick_audio(media: MediaRecord) -> Tuple[Format, bool]:
+    # bestaudio, demuxing it from a muxed rendition when there is no
+    # audio-only one and this server has ffmpeg
+    picked = select_audio(media, demux=remuxer.available)
+    if picked is None:
+        raise HTTPException(status_code=404, detail="No audio-only download is available for this video")
+    return picked
+
+def audio_ext(fmt: Format, demux: bool) -> str:
+    return demuxed_ext(fmt) if demux else fmt.ext
+
+async def relay_media(
+    source: dict, title: str, ext: str, request: Request, audio: Optional[dict] = None,
+) -> Response:
+    # `source` as from MediaRecord.source (or a download token). With `audio`
+    # the two are merged by ffmpeg, with `extract_audio` only its audio is
+    # kept; HLS/DASH renditions are joined from their fragments; anything
+    # else is relayed from the CDN as is
+    method = "HEAD" if request.method == "HEAD" else "GET"
+    if audio is not None:
+        return await remuxer.merge(source, audio, title, ext, max_bytes=DOWNLOAD_MAX_BYTES, method=method)
+    if source.get('extract_audio'):
+        return await remuxer.extract_audio(source, title, ext, max_bytes=DOWNLOAD_MAX_BYTES, method=method)
+    if source['protocol'] in FRAGMENTED_PROTOCOLS:
+        return await stream_fragments(
+            source['protocol'], source['url'], title, source.get('headers'),
+            manifest_url=source.get('manifest_url'), format_id=source.get('format_id'),
+            max_bytes=DOWNLOAD_MAX_BYTES, method=method,
+        )
+    return await stream_upstream(
+        source['url'], f"{title}.{ext}", source.get('headers'),
+        max_bytes=DOWNLOAD_MAX_BYTES, client_headers=request.headers, method=method,
+        media_type=source.get('media_type'),
+    )
+
+@cache_response(expire_time=300, key=lambda url: canonical_key(url))
+async def load_video_info(url: str):
+    processor = VideoProcessor(url)
+    info = await processor.get_info()
+    valid = await processor.is_duration_valid()
+    media = await processor.get_media() if valid and info.url else None
+    formats = [f.describe() for f in info.usable_formats()]
+    pair = select_merge(info, byte_budget(False)) if remuxer.available else None
+    if pair is not None:
+        # Separate best video and audio, merged on download
+        formats.insert(0, describe_merge(*pair, info.duration))
+    return {
+        'title': info.title,
+        'duration': humanize.precisedelta(info.duration),
+        'thumbnail': info.thumbnail,
+        'format': info.format,
+        'formats': formats,
+        'valid': valid,
+        # Kept with the cached response so download tokens can be minted
+        # without another extraction
+        'media': media.to_dict() if media is not None else None,
+    }
+
 @app.post("/video-info")
-@cache_response(expire_time=300)
-async def get_video_info(video: VideoURL):
+async def get_video_info(video: VideoURL, request: Request):
     try:
-        processor = VideoProcessor(video.url)
-        info = await processor.get_info()
-        
-        if not info:
-            raise HTTPException(status_code=400, detail="Could not fetch video information")
-
-        return {
-            'title': info.get('title', ''),
-            'duration': humanize.precisedelta(info.get('duration', 0)),
-            'thumbnail': info.get('thumbnail', ''),
-            'format': info.get('format', ''),
-            'valid': await processor.is_duration_valid()
-        }
+        response = dict(await load_video_info(video.url))
+        media = response.pop('media')
+        if media is not None:
+            media = MediaRecord.from_dict(media)
+            if media.expires_at is not None and media.expires_at - time.time() < MEDIA_URL_EXPIRY_MARGIN:
+                # Cached response outlived its signed URL; resolve it again
+                media = await VideoProcessor(video.url).get_media()
+            try:
+                selected = pick_download(media, wants_save_data(request.headers))
+                response['format_id'] = selected.format_id if selected is not None else media.format_id
+                response['token'] = download_tokens.issue(media, selected)
+            except HTTPException:
+                pass  # every rendition is over the hard cap: listed, no tokens
+            picked = select_audio(media, demux=remuxer.available)
+            if picked is not None:
+                fmt, demux = picked
+                ext = audio_ext(fmt, demux)
+                response['audio'] = {
+                    'format_id': "bestaudio",
+                    'ext': ext,
+                    # A demuxed file is only known to be smaller than its source
+                    'filesize': None if demux else estimated_size(fmt, media.duration),
+                    'token': download_tokens.issue(media, fmt, ext=ext, extract_audio=demux),
+                }
+            # New dicts: the listing itself is shared with the cache
+            formats = {
+                f.format_id: f for f in media.usable_formats() if within_cap(f, media.duration)
+            }
+
+            def token_for(listed: dict) -> Optional[str]:
+                video_id, _, audio_id = listed['format_id'].partition('+')
+                if video_id not in formats or (audio_id and audio_id not in formats):
+                    return None
+                if audio_id:
+                    return download_tokens.issue(
+                        media, formats[video_id], audio=formats[audio_id], ext=listed['ext']
+                    )
+                return download_tokens.issue(media, formats[video_id])
+
+            response['formats'] = [
+                {**listed, 'token': token} if (token := token_for(listed)) else listed
+                for listed in response['formats']
+            ]
+        return response
+    except ExtractionFailure as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.api_route("/download", methods=["GET", "HEAD"])
+async def download_with_token(token: str, request: Request):
+    # Everything needed was signed into the token by /video-info, so this
+    # goes straight to the CDN on any worker or instance
+    try:
+        claims = download_tokens.verify(token)
+    except InvalidToken as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    return await relay_media(claims, claims['title'], claims['ext'], request, audio=claims.get('audio'))
+
 @app.post("/download")
-async def download_video(video: VideoURL):
+async def download_video(video: VideoURL, request: Request):
     try:
         processor = VideoProcessor(video.url)
-        if not await processor.is_duration_valid():
+        # Resolved by a recent /video-info or extracted now; either way the
+        # duration check reads the same record
+        media = await processor.get_media()
+        if media.duration > MAX_DURATION:
             raise HTTPException(status_code=400, detail="Video duration should not exceed 2 minutes")
 
-        # Get video info first
-        info = await processor.get_info()
-        title = info.get('title', 'video')
-        ext = info.get('ext', 'mp4')
-        
-        def custom_hook(d):
-            if d['status'] == 'downloading':
-                pass
-            elif d['status'] == 'finished':
-                pass
-
-        ydl_opts = {
-            'format': 'best',
-            'quiet': True,
-            'no_warnings': True,
-            'progress_hooks': [custom_hook],
-            'socket_timeout': 10,
-        }
+        if video.format_id == "bestaudio":
+            fmt, demux = pick_audio(media)
+            source = {**media.source(fmt), 'extract_audio': True} if demux else media.source(fmt)
+            return await relay_media(source, media.title, audio_ext(fmt, demux), request)
 
-        # Download the video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video.url, download=False)
-            url = info['url']
-            
-            # Create response headers for browser download
-            headers = {
-                'Content-Disposition': f'attachment; filename="{title}.{ext}"',
-                'Cache-Control': 'no-cache'
-            }
-            
-            # Return a streaming response that will download directly in the browser
-            return StreamingResponse(
-                io.BytesIO(await asyncio.to_thread(lambda: requests.get(url, timeout=10).content)),
-                media_type='application/octet-stream',
-                headers=headers
+        if video.format_id is not None and "+" in video.format_id:
+            fmt, audio = pick_merge(media, video.format_id, wants_save_data(request.headers))
+            return await relay_media(
+                media.source(fmt), media.title, merged_ext(fmt), request, audio=media.source(audio)
             )
 
+        if video.format_id is not None:
+            fmt = media.get_format(video.format_id)
+            if fmt is None:
+                raise HTTPException(status_code=404, detail="Requested format is not available")
+            if not within_cap(fmt, media.duration):
+                raise HTTPException(status_code=413, detail="This video is too large to download")
+        else:
+            fmt = pick_download(media, wants_save_data(request.headers))
+        ext = fmt.ext if fmt is not None else media.ext
+
+        # Relay the CDN response chunk by chunk so memory stays flat per download
+        return await relay_media(media.source(fmt), media.title, ext, request)
+
+    except ExtractionFailure as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
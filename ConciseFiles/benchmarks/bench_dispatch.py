@@ -0,0 +1,52 @@
+# bench_dispatch.py
+# Time spent picking a yt-dlp extractor for a URL: yt-dlp's own search over
+# every extractor versus the front-door router in urls.py.
+#
+#   cd ConciseFiles && python benchmarks/bench_dispatch.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yt_dlp.extractor import gen_extractor_classes, get_info_extractor  # noqa: E402
+
+from urls import extractor_key  # noqa: E402
+
+URLS = [
+    "https://www.instagram.com/reel/CxYz_1-aBcD/?igsh=MTc4MmM1YmI2Ng==",
+    "https://www.instagram.com/stories/someone/3123456789012345678/",
+    "https://www.facebook.com/reel/1234567890123456",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+]
+ROUNDS = 200
+
+extractors = list(gen_extractor_classes())
+
+
+def full_scan(url):
+    # What YoutubeDL.extract_info does without ie_key
+    for ie in extractors:
+        if ie.suitable(url):
+            return ie.ie_key()
+
+
+def routed(url):
+    ie_key = extractor_key(url)
+    if ie_key is not None and get_info_extractor(ie_key).suitable(url):
+        return ie_key
+
+
+def main():
+    print(f"{len(extractors)} extractors, {ROUNDS} rounds per URL\n")
+    print(f"{'url':<70} {'scan us':>9} {'router us':>10} {'speedup':>8}")
+    for url in URLS:
+        assert full_scan(url) == routed(url), url  # also warms the regex caches
+        scan = timeit.timeit(lambda: full_scan(url), number=ROUNDS) / ROUNDS * 1e6
+        route = timeit.timeit(lambda: routed(url), number=ROUNDS) / ROUNDS * 1e6
+        print(f"{url[:70]:<70} {scan:>9.1f} {route:>10.1f} {scan / route:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
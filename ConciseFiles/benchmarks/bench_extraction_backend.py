@@ -0,0 +1,90 @@
+# bench_extraction_backend.py
+# Extraction throughput of the thread and process backends in extraction.py
+# under concurrent load. A local server stands in for the site: it serves a
+# large page (megabytes of markup, like a bloated post page) whose only video
+# is an HTML5 <video> tag, so yt-dlp's Generic extractor spends its time in
+# CPU-bound regex and HTML parsing rather than on the network.
+#
+#   cd ConciseFiles && python benchmarks/bench_extraction_backend.py [concurrency ...]
+#
+# The process backend only pays off with several cores; on one core it just
+# adds pickling and IPC on top of the same work.
+import asyncio
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import ExtractionService  # noqa: E402
+
+ROUNDS = 3
+YDL_OPTS = {'quiet': True, 'format': 'best', 'no_warnings': True, 'socket_timeout': 10}
+
+FILLER = "".join(
+    f'<div class="post" data-id="{i}"><a href="/p/{i}/">post {i}</a>'
+    f'<script type="application/json">{{"id": {i}, "caption": "{"lorem ipsum " * 8}"}}</script></div>\n'
+    for i in range(6000)
+)
+PAGE = (
+    "<html><head><title>Benchmark post</title>"
+    '<meta property="og:title" content="Benchmark post"></head><body>'
+    f"{FILLER}"
+    '<video controls><source src="/media/video.mp4" type="video/mp4"></video>'
+    "</body></html>"
+).encode()
+
+
+class FakeSite(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    do_HEAD = do_GET
+
+
+async def run(backend: str, concurrency: int, url: str) -> float:
+    service = ExtractionService(max_workers=concurrency, backend=backend, max_queue=concurrency)
+    await service.start()
+    await service._warm
+    # One untimed round so every thread/child has its YoutubeDL instance
+    await asyncio.gather(*(service.extract(f"{url}?warm={i}", YDL_OPTS, "Generic") for i in range(concurrency)))
+    started = time.perf_counter()
+    for r in range(ROUNDS):
+        records = await asyncio.gather(
+            *(service.extract(f"{url}?r={r}&i={i}", YDL_OPTS, "Generic") for i in range(concurrency))
+        )
+        assert all(record.url and record.url.endswith("/media/video.mp4") for record in records)
+    elapsed = time.perf_counter() - started
+    service.shutdown()
+    return ROUNDS * concurrency / elapsed
+
+
+async def main():
+    levels = [int(arg) for arg in sys.argv[1:]] or [1, 4, 8]
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/post"
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"{len(PAGE) / 1024 / 1024:.1f} MiB page, {cores} core(s) available")
+    print(f"{'concurrent':>10}  {'thread/s':>9}  {'process/s':>9}  speedup")
+    for concurrency in levels:
+        threaded = await run("thread", concurrency, url)
+        processes = await run("process", concurrency, url)
+        print(f"{concurrency:>10}  {threaded:>9.2f}  {processes:>9.2f}  {processes / threaded:.2f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+# bench_media_record.py
+# Memory held per cached entry: yt-dlp's full info dict versus the
+# MediaRecord projection in media.py.
+#
+#   cd ConciseFiles && python benchmarks/bench_media_record.py [info.json ...]
+#
+# Pass files written by `yt-dlp -J <url> > info.json` to measure real posts;
+# without arguments a synthetic YouTube-short-shaped info dict is used.
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media import MediaRecord  # noqa: E402
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-us,en;q=0.5",
+    "Sec-Fetch-Mode": "navigate",
+}
+
+
+def synthetic_info() -> dict:
+    signed = "https://rr3---sn-abc.googlevideo.com/videoplayback?expire=1700000000&ei=" + "x" * 700
+    formats = []
+    for i, height in enumerate([144, 240, 360, 480, 720, 1080, 1440, 2160] * 3):
+        formats.append({
+            "format_id": str(100 + i), "format_note": f"{height}p", "ext": "mp4",
+            "url": signed, "manifest_url": signed, "protocol": "https",
+            "width": height * 16 // 9, "height": height, "fps": 30, "tbr": height * 2.5,
+            "vcodec": "avc1.640028", "acodec": "none", "filesize": height * 20000,
+            "http_headers": dict(HEADERS), "downloader_options": {"http_chunk_size": 10485760},
+            "fragments": [{"url": f"{signed}&sq={n}", "duration": 5.0} for n in range(24)],
+        })
+    return {
+        "id": "dQw4w9WgXcQ", "extractor_key": "Youtube", "title": "Some short", "duration": 58,
+        "description": "d" * 2000, "tags": ["tag"] * 30, "ext": "mp4", "format": "22 - 1280x720",
+        "format_id": "22", "url": signed, "protocol": "https", "http_headers": dict(HEADERS),
+        "thumbnail": "https://i.ytimg.com/vi/x/maxresdefault.jpg",
+        "thumbnails": [{"url": f"https://i.ytimg.com/vi/x/{n}.jpg", "width": n, "height": n} for n in range(40)],
+        "automatic_captions": {f"l{n}": [{"url": signed, "ext": "vtt"}] for n in range(100)},
+        "formats": formats, "requested_formats": None,
+    }
+
+
+def deep_size(obj, seen=None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+
+def report(name: str, info: dict) -> None:
+    record = MediaRecord.from_info(info)
+    full = deep_size(info)
+    slim = deep_size(record)
+    print(f"{name:<30} {full / 1024:>10.1f} {slim / 1024:>10.1f} {full / slim:>8.1f}x")
+
+
+def main():
+    print(f"{'info':<30} {'full KiB':>10} {'record KiB':>10} {'ratio':>9}")
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path) as f:
+                report(os.path.basename(path), json.load(f))
+    else:
+        report("synthetic YouTube short", synthetic_info())
+
+
+if __name__ == "__main__":
+    main()
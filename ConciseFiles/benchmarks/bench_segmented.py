@@ -0,0 +1,109 @@
+# bench_segmented.py
+# Time to relay a large object from a CDN that throttles each connection:
+# one plain GET versus the parallel byte-range fetch in streaming.py. The
+# CDN is a local HTTP server capped at THROTTLE bytes/s per connection.
+#
+#   cd ConciseFiles && python benchmarks/bench_segmented.py
+import asyncio
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import CHUNK_SIZE, UpstreamPool, segmented_body  # noqa: E402
+
+OBJECT_SIZE = 32 * 1024 * 1024
+THROTTLE = 4 * 1024 * 1024
+SEGMENT_SIZE = 2 * 1024 * 1024
+CONCURRENCY = (2, 4, 8)
+
+payload = os.urandom(OBJECT_SIZE)
+expected = hashlib.sha256(payload).hexdigest()
+
+
+class FakeCDN(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start, end = 0, OBJECT_SIZE - 1
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            first, _, last = byte_range.removeprefix("bytes=").partition("-")
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{OBJECT_SIZE}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        began = time.monotonic()
+        sent = 0
+        for offset in range(start, end + 1, CHUNK_SIZE):
+            chunk = payload[offset:min(offset + CHUNK_SIZE, end + 1)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            ahead = sent / THROTTLE - (time.monotonic() - began)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+async def single(pool, url):
+    upstream = await pool.open(url, headers={"Accept-Encoding": "identity"})
+    digest = hashlib.sha256()
+    try:
+        async for chunk in upstream.response.aiter_raw(CHUNK_SIZE):
+            digest.update(chunk)
+    finally:
+        await upstream.aclose()
+    return digest.hexdigest()
+
+
+async def segmented(pool, url, concurrency):
+    headers = {"Accept-Encoding": "identity"}
+    # The first segment's slot plus one per segment in flight
+    reservation = await pool.reserve(url, concurrency + 1)
+    first = await pool.open(
+        url, headers={**headers, "Range": f"bytes=0-{SEGMENT_SIZE - 1}"}, reservation=reservation
+    )
+    digest = hashlib.sha256()
+    async for chunk in segmented_body(first, url, headers, OBJECT_SIZE, reservation, SEGMENT_SIZE, pool):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCDN)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/video.mp4"
+    pool = UpstreamPool()
+    await pool.start()
+
+    mb = OBJECT_SIZE / 1024 / 1024
+    print(f"{mb:.0f} MiB object, CDN capped at {THROTTLE / 1024 / 1024:.0f} MiB/s per connection")
+    began = time.perf_counter()
+    assert await single(pool, url) == expected
+    baseline = time.perf_counter() - began
+    print(f"  single connection      {baseline:6.2f} s  {mb / baseline:6.1f} MiB/s")
+    for concurrency in CONCURRENCY:
+        began = time.perf_counter()
+        assert await segmented(pool, url, concurrency) == expected
+        elapsed = time.perf_counter() - began
+        print(
+            f"  {concurrency} segments in flight  {elapsed:6.2f} s  {mb / elapsed:6.1f} MiB/s"
+            f"  ({baseline / elapsed:.1f}x)"
+        )
+
+    await pool.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,231 @@
+# bench_segmented_tls.py
+# bench_segmented.py against a CDN that speaks HTTP/2 over TLS, like
+# googlevideo or scontent: one plain download, the parallel byte-range fetch
+# in streaming.py, and that fetch with its segments multiplexed onto one
+# HTTP/2 connection (what the shared pool client would do). The CDN is a
+# local TLS server offering h2 and http/1.1 by ALPN, capped at THROTTLE
+# bytes/s per connection across all of its streams.
+#
+#   cd ConciseFiles && python benchmarks/bench_segmented_tls.py
+import asyncio
+import datetime
+import hashlib
+import ipaddress
+import os
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OBJECT_SIZE = 32 * 1024 * 1024
+THROTTLE = 4 * 1024 * 1024
+SEGMENT_SIZE = 2 * 1024 * 1024
+CONCURRENCY = 4
+CHUNK = 16 * 1024
+# Read by streaming.py at import
+os.environ["SEGMENT_SIZE"] = str(SEGMENT_SIZE)
+
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+import h2.settings  # noqa: E402
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+import streaming  # noqa: E402
+
+payload = os.urandom(OBJECT_SIZE)
+expected = hashlib.sha256(payload).hexdigest()
+
+
+def certificate(directory: str):
+    # Self-signed certificate for 127.0.0.1; also the client's CA bundle
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+    return cert_path, key_path
+
+
+def byte_range(value):
+    if not value:
+        return 0, OBJECT_SIZE - 1, False
+    first, _, last = value.removeprefix("bytes=").partition("-")
+    return int(first), min(int(last or OBJECT_SIZE - 1), OBJECT_SIZE - 1), True
+
+
+class Throttle:
+    # THROTTLE bytes/s for one connection, whatever the number of streams
+    def __init__(self):
+        self.began = time.monotonic()
+        self.sent = 0
+
+    async def take(self, size: int) -> None:
+        self.sent += size
+        ahead = self.sent / THROTTLE - (time.monotonic() - self.began)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+
+async def serve_http1(reader, writer):
+    throttle = Throttle()
+    while True:
+        head = await reader.readuntil(b"\r\n\r\n")
+        headers = dict(
+            line.split(": ", 1) for line in head.decode().split("\r\n")[1:] if ": " in line
+        )
+        ranged = {k.lower(): v for k, v in headers.items()}.get("range")
+        start, end, partial = byte_range(ranged)
+        status = "206 Partial Content" if partial else "200 OK"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Length: {end - start + 1}\r\n"
+            f"Content-Range: bytes {start}-{end}/{OBJECT_SIZE}\r\nAccept-Ranges: bytes\r\n\r\n".encode()
+        )
+        for offset in range(start, end + 1, CHUNK):
+            chunk = payload[offset:min(offset + CHUNK, end + 1)]
+            writer.write(chunk)
+            await writer.drain()
+            await throttle.take(len(chunk))
+
+
+async def serve_h2(reader, writer):
+    throttle = Throttle()
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+    conn.initiate_connection()
+    conn.update_settings({h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: 2 ** 24})
+    writer.write(conn.data_to_send())
+    window = asyncio.Event()
+    streams = {}
+
+    async def respond(stream_id, headers):
+        start, end, partial = byte_range(headers.get("range"))
+        conn.send_headers(stream_id, [
+            (":status", "206" if partial else "200"),
+            ("content-length", str(end - start + 1)),
+            ("content-range", f"bytes {start}-{end}/{OBJECT_SIZE}"),
+        ])
+        offset = start
+        while offset <= end:
+            size = min(CHUNK, end + 1 - offset, conn.local_flow_control_window(stream_id))
+            if size <= 0:
+                window.clear()
+                await window.wait()
+                continue
+            conn.send_data(stream_id, payload[offset:offset + size])
+            offset += size
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            await throttle.take(size)
+        conn.end_stream(stream_id)
+        writer.write(conn.data_to_send())
+
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                headers = {k.decode(): v.decode() for k, v in event.headers}
+                streams[event.stream_id] = asyncio.ensure_future(respond(event.stream_id, headers))
+            elif isinstance(event, h2.events.WindowUpdated):
+                window.set()
+            elif isinstance(event, h2.events.StreamReset):
+                task = streams.pop(event.stream_id, None)
+                if task is not None:
+                    task.cancel()
+        writer.write(conn.data_to_send())
+    for task in streams.values():
+        task.cancel()
+
+
+async def serve(reader, writer):
+    try:
+        if writer.get_extra_info("ssl_object").selected_alpn_protocol() == "h2":
+            await serve_h2(reader, writer)
+        else:
+            await serve_http1(reader, writer)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_cdn(cert_path, key_path):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    context.set_alpn_protocols(["h2", "http/1.1"])
+    # On a loop of its own, so its throttling does not slow the client down
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(
+        asyncio.start_server(serve, "127.0.0.1", 0, ssl=context), loop
+    ).result()
+    return server.sockets[0].getsockname()[1]
+
+
+async def download(url):
+    response = await streaming.stream_upstream(url, "video.mp4")
+    digest = hashlib.sha256()
+    async for chunk in response.body_iterator:
+        digest.update(chunk)
+    await response.background()
+    return digest.hexdigest()
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = certificate(directory)
+        os.environ["SSL_CERT_FILE"] = cert_path  # trusted by httpx clients made from here on
+        url = f"https://127.0.0.1:{start_cdn(cert_path, key_path)}/video.mp4"
+        pool = streaming.upstream_pool
+        await pool.start()
+        print(f"{OBJECT_SIZE // 1024 // 1024} MiB object over TLS, CDN capped at "
+              f"{THROTTLE // 1024 // 1024} MiB/s per connection, HTTP/2 "
+              f"{'on' if streaming.HTTP2_AVAILABLE else 'unavailable'}")
+        http1 = pool.parallel_client
+        variants = [
+            ("single HTTP/2 stream", 1, http1),
+            (f"{CONCURRENCY} segments, one HTTP/2 connection", CONCURRENCY, pool.client),
+            (f"{CONCURRENCY} segments, HTTP/1.1 connections", CONCURRENCY, http1),
+        ]
+        baseline = None
+        for label, concurrency, parallel_client in variants:
+            streaming.SEGMENT_CONCURRENCY = concurrency
+            pool._parallel_client = parallel_client
+            began = time.perf_counter()
+            digest = await download(url)
+            elapsed = time.perf_counter() - began
+            assert digest == expected, label
+            baseline = baseline or elapsed
+            print(f"  {label:38} {elapsed:6.2f} s  {OBJECT_SIZE / elapsed / 1024 / 1024:6.1f} MiB/s"
+                  f"  ({baseline / elapsed:.1f}x)")
+        stats = pool.stats()
+        print(f"  requests {stats['requests']}, connections opened {stats['connections_opened']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
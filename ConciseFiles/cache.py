@@ -0,0 +1,252 @@
+# cache.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import ujson
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+except ImportError:  # Redis is optional; without it every worker caches locally
+    aioredis = None
+    RedisError = Exception
+
+logger = logging.getLogger(__name__)
+
+# Shared cache for all uvicorn workers, e.g. redis://localhost:6379/0
+REDIS_URL = os.environ.get("REDIS_URL")
+REDIS_KEY_PREFIX = os.environ.get("REDIS_KEY_PREFIX", "ytdown:")
+
+
+# In-process LRU cache with a per-entry TTL. Lookups and inserts are O(1):
+# entries live in an OrderedDict kept in recency order, expiry is checked
+# lazily on read, and inserting past maxsize evicts the least recently used.
+class TTLCache:
+    def __init__(self, maxsize: int = 100, default_ttl: float = 300):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data: "OrderedDict[Hashable, tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.default_ttl if ttl is None else ttl
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def purge_expired(self) -> int:
+        # Single linear pass, no sorting; reads already drop stale entries
+        # lazily, so this only reclaims memory held by keys nobody asks for
+        now = time.monotonic()
+        expired = [k for k, (_, expires_at) in self._data.items() if expires_at <= now]
+        for k in expired:
+            del self._data[k]
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Cache shared by every worker and instance through Redis. Values are stored
+# as compact JSON with a TTL so redis.conf's volatile-lru policy can evict
+# them. Redis failures are treated as misses so requests never fail on them.
+class RedisBackend:
+    def __init__(self, url: str, prefix: str = REDIS_KEY_PREFIX):
+        self.url = url
+        self.prefix = prefix
+        self.client = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def start(self) -> None:
+        if self.client is None:
+            self.client = aioredis.from_url(
+                self.url, socket_timeout=0.5, socket_connect_timeout=0.5, health_check_interval=30
+            )
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _failed(self, e: Exception) -> None:
+        self.errors += 1
+        logger.warning("Redis cache unavailable, using local cache only: %s", e)
+
+    async def get(self, key: str) -> Any:
+        try:
+            raw = await self.client.get(self.prefix + key)
+        except RedisError as e:
+            self._failed(e)
+            return None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ujson.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        try:
+            await self.client.set(self.prefix + key, ujson.dumps(value), ex=max(int(ttl), 1))
+        except RedisError as e:
+            self._failed(e)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+# Two-tier cache: a small per-worker L1 in front of the shared Redis L2.
+# Entries carry a soft expiry (fresh until then) and a hard expiry (evicted
+# after). Between the two they are still served immediately while a single
+# background task reloads them and refreshes both tiers.
+class TieredCache:
+    def __init__(self, l1: TTLCache, l2: Optional[RedisBackend] = None):
+        self.l1 = l1
+        self.l2 = l2
+        self._refreshing: set = set()
+        self._tasks: set = set()
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def start(self) -> None:
+        if self.l2 is not None:
+            await self.l2.start()
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self.l2 is not None:
+            await self.l2.close()
+
+    async def _lookup(self, key: str):
+        # Entries are (soft_expires_at, hard_expires_at, value) in wall-clock
+        # time so every worker agrees on freshness
+        entry = self.l1.get(key)
+        if entry is not None:
+            self.l1_hits += 1
+            return entry
+        if self.l2 is not None:
+            entry = await self.l2.get(key)
+            if entry is not None:
+                self.l2_hits += 1
+                remaining = entry[1] - time.time()
+                if remaining > 0:
+                    self.l1.put(key, entry, ttl=remaining)
+                return entry
+        return None
+
+    async def get(self, key: str) -> Any:
+        # Fresh values only; callers that can use stale data go through get_or_load
+        entry = await self._lookup(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[2]
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any, ttl: float, stale_ttl: float = 0) -> None:
+        now = time.time()
+        entry = (now + ttl, now + ttl + stale_ttl, value)
+        self.l1.put(key, entry, ttl=ttl + stale_ttl)
+        if self.l2 is not None:
+            await self.l2.set(key, entry, ttl + stale_ttl)
+
+    def _refresh(self, key: str, loader, ttl: float, stale_ttl: float) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def refresh():
+            try:
+                await self.set(key, await loader(), ttl, stale_ttl)
+                self.refreshes += 1
+            except Exception as e:
+                self.refresh_errors += 1
+                logger.info("Background refresh of %s failed: %s", key, e)
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def get_or_load(self, key: str, loader, ttl: float, stale_ttl: float = 0) -> Any:
+        entry = await self._lookup(key)
+        if entry is not None:
+            soft_expires_at, _, value = entry
+            if soft_expires_at <= time.time():
+                self.stale_hits += 1
+                self._refresh(key, loader, ttl, stale_ttl)
+            return value
+
+        self.misses += 1
+        value = await loader()
+        await self.set(key, value, ttl, stale_ttl)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "l1": self.l1.stats(),
+            "l2": self.l2.stats() if self.l2 is not None else None,
+        }
+
+
+def create_cache(
+    l1: TTLCache,
+    url: Optional[str] = REDIS_URL,
+    l2: Optional[RedisBackend] = None,
+) -> TieredCache:
+    # Pass l2 to share one Redis connection pool between several caches
+    if l2 is not None:
+        return TieredCache(l1, l2)
+    if url and aioredis is not None:
+        return TieredCache(l1, RedisBackend(url))
+    return TieredCache(l1)
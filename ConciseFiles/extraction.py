@@ -0,0 +1,341 @@
+# extraction.py
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from media import MediaRecord
+from urls import EXTRACTOR_ROUTES
+
+logger = logging.getLogger(__name__)
+
+# "thread" runs extractions on a thread pool; "process" runs them in warm,
+# long-lived child processes so their CPU-bound parsing is not serialized on
+# this worker's GIL
+EXTRACTION_BACKEND = os.environ.get("EXTRACTION_BACKEND", "thread")
+# Number of threads (or child processes) dedicated to yt-dlp extraction in each worker
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", "8"))
+# Extractions allowed to run at once (at most one per thread)
+EXTRACTION_MAX_IN_FLIGHT = int(os.environ.get("EXTRACTION_MAX_IN_FLIGHT", str(EXTRACTION_WORKERS)))
+# Extractions allowed to wait for a slot, and for how long, before new ones
+# are turned away with a 503 instead of piling up behind the pool
+EXTRACTION_QUEUE_SIZE = int(os.environ.get("EXTRACTION_QUEUE_SIZE", "32"))
+EXTRACTION_QUEUE_TIMEOUT = float(os.environ.get("EXTRACTION_QUEUE_TIMEOUT", "10"))
+
+
+# Extractors loaded by the warm-up: every one the URL router can pick
+WARM_EXTRACTORS = tuple(dict.fromkeys(ie_key for routes in EXTRACTOR_ROUTES.values() for _, ie_key in routes))
+
+
+def _yt_dlp():
+    # yt-dlp is imported on first use (the warm-up, normally) rather than at
+    # module load, so workers come up and serve pages without paying for it.
+    # In process mode the parent never imports it at all.
+    import yt_dlp
+    return yt_dlp
+
+
+# How long each kind of failure is remembered, in seconds (0 = never cached)
+# and the status it is reported with
+FAILURE_POLICIES = {
+    "unsupported": (3600, 400),
+    "not_found": (600, 404),
+    "private": (300, 403),
+    "geo_restricted": (600, 451),
+    "rate_limited": (30, 503),
+    "timeout": (0, 504),
+    "network": (0, 502),
+    "overloaded": (0, 503),
+    "other": (30, 500),
+}
+
+# First match wins. Rate limiting comes first: Instagram reports it as
+# "Requested content is not available, rate-limit reached or login required",
+# which would otherwise read as a private post cached for minutes
+FAILURE_PATTERNS = (
+    ("rate_limited", re.compile(r"429|too many requests|rate.?limit", re.I)),
+    ("unsupported", re.compile(r"unsupported url|no video formats found|is not a valid url", re.I)),
+    ("private", re.compile(r"private|login required|log in|sign in|cookies|age[- ]restricted|confirm your age", re.I)),
+    ("not_found", re.compile(r"404|not found|unavailable|removed|deleted|does not exist|no longer available", re.I)),
+    ("geo_restricted", re.compile(r"not available in your country|geo.?restrict", re.I)),
+    ("timeout", re.compile(r"timed? ?out|timeout", re.I)),
+    ("network", re.compile(r"unable to download webpage|failed to resolve|connection (refused|reset)|transporterror", re.I)),
+)
+
+
+class ExtractionFailure(Exception):
+    def __init__(self, category: str, message: str):
+        super().__init__(message)
+        self.category = category
+        self.message = message
+        self.ttl, self.status_code = FAILURE_POLICIES[category]
+
+    def __reduce__(self):
+        return (ExtractionFailure, (self.category, self.message))
+
+    def to_dict(self) -> dict:
+        return {"category": self.category, "message": self.message}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ExtractionFailure":
+        return cls(data["category"], data["message"])
+
+
+def classify_error(e: Exception) -> ExtractionFailure:
+    if isinstance(e, ExtractionFailure):
+        return e
+    # DownloadError wraps the extractor's own exception in exc_info
+    cause = getattr(e, "exc_info", None)
+    cause = cause[1] if cause else e
+    # Only yt-dlp raises its own error types, so no need to import it here
+    yt_dlp = sys.modules.get("yt_dlp")
+    if yt_dlp is not None and isinstance(cause, yt_dlp.utils.UnsupportedError):
+        category = "unsupported"
+    elif yt_dlp is not None and isinstance(cause, yt_dlp.utils.GeoRestrictedError):
+        category = "geo_restricted"
+    elif isinstance(cause, (TimeoutError, asyncio.TimeoutError)):
+        category = "timeout"
+    else:
+        message = str(e)
+        category = next((name for name, pattern in FAILURE_PATTERNS if pattern.search(message)), "other")
+    # yt-dlp prefixes messages with "ERROR: [extractor] id:"
+    message = re.sub(r"^ERROR:\s*(\[[^\]]+\]\s*)?([\w-]+:\s*)?", "", str(e)).strip() or category
+    return ExtractionFailure(category, message)
+
+
+# Pre-built YoutubeDL instances, one per thread and options profile, so
+# extractor lists, openers and cookie jars are set up once rather than on
+# every request. Each thread only ever uses its own instances, and a child
+# process in process mode is single-threaded, so nothing is shared between
+# concurrent extractions.
+class YoutubeDLPool:
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances: list = []
+        self.created = 0
+        self.reused = 0
+
+    def get(self, ydl_opts: dict) -> "yt_dlp.YoutubeDL":
+        ydls = getattr(self._local, "ydls", None)
+        if ydls is None:
+            ydls = self._local.ydls = {}
+        profile = repr(sorted(ydl_opts.items()))
+        ydl = ydls.get(profile)
+        with self._lock:
+            if ydl is None:
+                # A copy: YoutubeDL writes into the dict it is given (http_headers),
+                # which would change the caller's profile key and, in process
+                # mode, make the options unpicklable on the next call
+                ydl = ydls[profile] = _yt_dlp().YoutubeDL(dict(ydl_opts))
+                self._instances.append(ydl)
+                self.created += 1
+            else:
+                self.reused += 1
+        return ydl
+
+    def close(self) -> None:
+        with self._lock:
+            instances, self._instances = self._instances, []
+        for ydl in instances:
+            ydl.close()
+
+    def stats(self) -> dict:
+        return {"instances": len(self._instances), "created": self.created, "reused": self.reused}
+
+
+ydl_pool = YoutubeDLPool()
+
+
+def _extract(url: str, ydl_opts: dict, ie_key: Optional[str] = None) -> MediaRecord:
+    ydl = ydl_pool.get(ydl_opts)
+    if ie_key is not None and not ydl.get_info_extractor(ie_key).suitable(url):
+        ie_key = None  # router and yt-dlp disagree; let yt-dlp search
+    try:
+        # Projected straight away; the full info dict dies with this frame
+        return MediaRecord.from_info(ydl.extract_info(url, download=False, ie_key=ie_key))
+    except Exception as e:
+        # yt-dlp errors hold tracebacks, which cannot cross the process boundary
+        raise classify_error(e) from None
+
+
+def _warm_up() -> float:
+    # Imports yt-dlp and loads (and compiles the URL patterns of) the
+    # extractors we route to, before the first real request needs them
+    started = time.perf_counter()
+    extractor = _yt_dlp().extractor
+    for ie_key in WARM_EXTRACTORS:
+        extractor.get_info_extractor(ie_key).suitable("")
+    return time.perf_counter() - started
+
+
+class Timing:
+    # Running count/total/max of a duration, in seconds
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+# Runs every yt-dlp extraction on a bounded, dedicated thread pool so a slow
+# Instagram/YouTube round trip never blocks the event loop thread. Admission
+# is bounded too: at most max_in_flight run, at most max_queue wait.
+class ExtractionService:
+    def __init__(
+        self,
+        max_workers: int = EXTRACTION_WORKERS,
+        backend: str = EXTRACTION_BACKEND,
+        max_in_flight: int = EXTRACTION_MAX_IN_FLIGHT,
+        max_queue: int = EXTRACTION_QUEUE_SIZE,
+        queue_timeout: float = EXTRACTION_QUEUE_TIMEOUT,
+    ):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown extraction backend: {backend}")
+        self.max_workers = max_workers
+        self.backend = backend
+        self.max_in_flight = min(max_in_flight, max_workers)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.queued = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.failed = 0
+        self.queue_wait = Timing()
+        self.run_time = Timing()
+        self._warm: Optional[asyncio.Future] = None
+        self.warm_up_seconds: Optional[float] = None
+        self.warm_up_error: Optional[str] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.backend == "process":
+                # spawn, not fork: the parent has a running event loop and threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_up,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="yt-dlp",
+                )
+        return self._executor
+
+    async def start(self) -> None:
+        # Warm up in the background: pages are served straight away, while
+        # extractions (and /ready) wait for the warm-up to finish
+        if self._warm is None:
+            self._warm = asyncio.ensure_future(self._warm_up())
+
+    async def _warm_up(self) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        # In process mode this also starts every child now, so none pays the
+        # spawn and import cost on a user's request
+        runs = self.max_workers if self.backend == "process" else 1
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self.executor, _warm_up) for _ in range(runs)))
+        except Exception as e:
+            # Only an optimisation: extractions import whatever they need
+            # themselves, so a failed warm-up (e.g. an extractor renamed by a
+            # yt-dlp upgrade) must not keep the worker unready
+            self.warm_up_error = repr(e)
+            logger.warning("Extraction warm-up failed, continuing cold: %r", e)
+        self.warm_up_seconds = loop.time() - started
+
+    async def wait_ready(self) -> None:
+        # Returns once the warm-up has finished, failed or been cancelled
+        if self._warm is not None and not self._warm.done():
+            try:
+                await asyncio.shield(self._warm)
+            except (Exception, asyncio.CancelledError):
+                if not self._warm.done():
+                    raise  # the caller itself was cancelled
+
+    @property
+    def ready(self) -> bool:
+        return self._warm is not None and self._warm.done()
+
+    async def _admit(self) -> None:
+        if not self._slots.locked():
+            await self._slots.acquire()  # free slot, no waiting
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise ExtractionFailure("overloaded", "Server is busy, please try again in a moment")
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ExtractionFailure("overloaded", "Server is busy, please try again in a moment")
+        finally:
+            self.queued -= 1
+
+    async def extract(self, url: str, ydl_opts: dict, ie_key: Optional[str] = None) -> MediaRecord:
+        await self.wait_ready()
+        loop = asyncio.get_running_loop()
+        enqueued_at = loop.time()
+        await self._admit()
+        started_at = loop.time()
+        self.queue_wait.record(started_at - enqueued_at)
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self.executor, _extract, url, ydl_opts, ie_key)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            self.run_time.record(loop.time() - started_at)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        ydl_pool.close()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "ready": self.ready,
+            "warm_up_s": self.warm_up_seconds,
+            "warm_up_error": self.warm_up_error,
+            "workers": self.max_workers,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "queue_wait": self.queue_wait.stats(),
+            "run_time": self.run_time.stats(),
+            # Children in process mode keep their own pools, not visible here
+            "ydl_pool": ydl_pool.stats() if self.backend == "thread" else None,
+        }
+
+
+extraction_service = ExtractionService()
@@ -0,0 +1,143 @@
+# formats.py
+import os
+from typing import Optional, Tuple
+
+from media import Format, MediaRecord
+
+MB = 1024 * 1024
+
+# Largest rendition we pick by default, and the tighter one for clients
+# sending "Save-Data: on"
+DOWNLOAD_BYTE_BUDGET = int(os.environ.get("DOWNLOAD_BYTE_BUDGET", str(64 * MB)))
+SAVE_DATA_BYTE_BUDGET = int(os.environ.get("SAVE_DATA_BYTE_BUDGET", str(16 * MB)))
+# Nothing larger is ever streamed, whichever format is asked for
+DOWNLOAD_MAX_BYTES = int(os.environ.get("DOWNLOAD_MAX_BYTES", str(256 * MB)))
+
+
+def wants_save_data(headers) -> bool:
+    return headers.get("save-data", "").strip().lower() == "on"
+
+
+def byte_budget(save_data: bool) -> int:
+    return min(SAVE_DATA_BYTE_BUDGET if save_data else DOWNLOAD_BYTE_BUDGET, DOWNLOAD_MAX_BYTES)
+
+
+def estimated_size(fmt: Format, duration: float) -> Optional[int]:
+    # Reported size when yt-dlp has one, else bitrate (kbit/s) x duration
+    if fmt.size:
+        return int(fmt.size)
+    bitrate = fmt.tbr or fmt.abr
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def within_cap(fmt: Format, duration: float) -> bool:
+    # Unknown sizes pass here and are capped while streaming instead
+    size = estimated_size(fmt, duration)
+    return size is None or size <= DOWNLOAD_MAX_BYTES
+
+
+def select_format(media: MediaRecord, budget: int) -> Optional[Format]:
+    # Best muxed rendition that fits the budget; failing that one of unknown
+    # size, then the smallest under the hard cap. None when nothing fits, or
+    # when yt-dlp listed no formats (the record's own url is then all we have)
+    candidates = [f for f in media.usable_formats() if f.muxed]
+    sized = [(f, estimated_size(f, media.duration)) for f in candidates]
+
+    for fmt, size in sized:
+        if size is not None and size <= budget:
+            return fmt
+    for fmt, size in sized:
+        if size is None:
+            return fmt
+    capped = [(size, fmt) for fmt, size in sized if size <= DOWNLOAD_MAX_BYTES]
+    if capped:
+        return min(capped, key=lambda pair: pair[0])[1]
+    return None
+
+
+# Containers a video-only rendition is merged into, and the audio codecs
+# that go with each without transcoding
+MERGE_CONTAINERS = {"mp4": ("mp4", "m4a"), "webm": ("webm",)}
+
+
+def merged_ext(video: Format) -> str:
+    return "mp4" if video.ext == "mp4" else "webm"
+
+
+def merged_size(video: Format, audio: Format, duration: float) -> Optional[int]:
+    sizes = (estimated_size(video, duration), estimated_size(audio, duration))
+    return None if None in sizes else sum(sizes)
+
+
+def select_merge(media: MediaRecord, budget: int) -> Optional[Tuple[Format, Format]]:
+    # bestvideo+bestaudio: each video-only rendition is paired with the best
+    # audio-only one for its container, then chosen like select_format does.
+    # None when there are no separate streams to merge.
+    usable = media.usable_formats()
+    audios = sorted(
+        (f for f in usable if f.has_audio and not f.has_video),
+        key=lambda f: (f.abr or f.tbr or 0), reverse=True,
+    )
+    pairs = []
+    for video in (f for f in usable if f.has_video and not f.has_audio):
+        exts = MERGE_CONTAINERS.get(merged_ext(video), ())
+        audio = next((a for a in audios if a.ext in exts), None)
+        if audio is None:
+            continue
+        pairs.append((video, audio, merged_size(video, audio, media.duration)))
+
+    for video, audio, size in pairs:
+        if size is not None and size <= budget:
+            return video, audio
+    for video, audio, size in pairs:
+        if size is None:
+            return video, audio
+    capped = [(size, video, audio) for video, audio, size in pairs if size <= DOWNLOAD_MAX_BYTES]
+    if capped:
+        _, video, audio = min(capped, key=lambda pair: pair[0])
+        return video, audio
+    return None
+
+
+def describe_merge(video: Format, audio: Format, duration: float) -> dict:
+    # Listing entry for a pair, under yt-dlp's "<video>+<audio>" format id
+    return {
+        **video.describe(),
+        "format_id": f"{video.format_id}+{audio.format_id}",
+        "ext": merged_ext(video),
+        "acodec": audio.acodec,
+        "filesize": merged_size(video, audio, duration),
+        "filesize_approx": True,
+        "muxed": True,
+        "note": "merged",
+    }
+
+
+# Container an audio stream is copied into when demuxed from a muxed file,
+# by codec; each can be written to a pipe
+DEMUXED_EXTS = {"mp4a": "aac", "aac": "aac", "opus": "webm", "vorbis": "webm", "mp3": "mp3"}
+
+
+def demuxed_ext(fmt: Format) -> str:
+    codec = (fmt.acodec or "").split(".")[0]
+    if codec in DEMUXED_EXTS:
+        return DEMUXED_EXTS[codec]
+    # Unknown codec (common on Instagram): go by the container
+    return "webm" if fmt.ext == "webm" else "aac"
+
+
+def select_audio(media: MediaRecord, demux: bool = True) -> Optional[Tuple[Format, bool]]:
+    # bestaudio: the best audio-only rendition; failing that (and when `demux`
+    # is possible) the muxed one with the best audio, smallest first, whose
+    # audio is then demuxed. The bool says whether demuxing is needed.
+    usable = [f for f in media.usable_formats() if within_cap(f, media.duration)]
+    audios = [f for f in usable if f.has_audio and not f.has_video]
+    if audios:
+        return max(audios, key=lambda f: (f.abr or f.tbr or 0)), False
+    muxed = [f for f in usable if f.muxed]
+    if not demux or not muxed:
+        return None
+    best = max(muxed, key=lambda f: (f.abr or 0, -(estimated_size(f, media.duration) or 0)))
+    return best, True
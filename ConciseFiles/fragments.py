@@ -0,0 +1,386 @@
+# fragments.py
+import os
+import re
+import xml.etree.ElementTree as ET
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from media import DASH_PROTOCOLS, HLS_PROTOCOLS
+from streaming import (
+    DownloadTooLarge, InOrder, SlotReservation, download_headers, fetch_bytes, upstream_pool,
+)
+
+# Fragments downloading at once per client; also the number buffered for
+# in-order delivery
+FRAGMENT_CONCURRENCY = int(os.environ.get("FRAGMENT_CONCURRENCY", "4"))
+# A playlist or MPD larger than this is not a VOD manifest we want to parse
+MANIFEST_MAX_BYTES = 2 * 1024 * 1024
+
+fragment_stats = {"downloads": 0, "segments": 0, "retries": 0, "failures": 0}
+
+
+class Fragment:
+    __slots__ = ("url", "byte_range")
+
+    def __init__(self, url: str, byte_range: Optional[Tuple[int, int]] = None):
+        self.url = url
+        # Inclusive (start, end), or None for the whole resource
+        self.byte_range = byte_range
+
+
+class FragmentPlan:
+    # Everything needed to stream one rendition: its fragments in order
+    # (initialization segment first) and what the joined bytes are
+    __slots__ = ("fragments", "ext", "media_type")
+
+    def __init__(self, fragments: List[Fragment], ext: str, media_type: str):
+        self.fragments = fragments
+        self.ext = ext
+        self.media_type = media_type
+
+
+def unsupported(detail: str) -> HTTPException:
+    return HTTPException(status_code=422, detail=detail)
+
+
+# --- HLS ---------------------------------------------------------------------
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _attributes(line: str) -> Dict[str, str]:
+    return {k: v.strip('"') for k, v in ATTRIBUTE_RE.findall(line.partition(":")[2])}
+
+
+def _byte_range(spec: str, previous_end: int) -> Tuple[int, int]:
+    # "<length>[@<offset>]"; without an offset it follows the previous range
+    length, _, offset = spec.partition("@")
+    start = int(offset) if offset else previous_end + 1
+    return start, start + int(length) - 1
+
+
+def best_variant(playlist: str, base_url: str) -> Optional[str]:
+    # Highest-bandwidth variant of a master playlist, None for a media playlist
+    best, best_bandwidth = None, -1
+    lines = playlist.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("#EXT-X-STREAM-INF"):
+            bandwidth = int(_attributes(line).get("BANDWIDTH") or 0)
+            uri = next((u.strip() for u in lines[i + 1:] if u.strip() and not u.startswith("#")), None)
+            if uri and bandwidth > best_bandwidth:
+                best, best_bandwidth = urljoin(base_url, uri), bandwidth
+    return best
+
+
+def parse_m3u8(playlist: str, base_url: str) -> FragmentPlan:
+    # VOD media playlist -> fragments. Encrypted and live playlists are refused
+    if not playlist.lstrip().startswith("#EXTM3U"):
+        raise unsupported("Not an HLS playlist")
+    fragments: List[Fragment] = []
+    pending_range = None
+    last_end = -1
+    fmp4 = False
+    for raw in playlist.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-KEY"):
+            if _attributes(line).get("METHOD", "NONE") != "NONE":
+                raise unsupported("Encrypted streams are not supported")
+        elif line.startswith("#EXT-X-MAP"):
+            attributes = _attributes(line)
+            byte_range = _byte_range(attributes["BYTERANGE"], -1) if "BYTERANGE" in attributes else None
+            fragments.append(Fragment(urljoin(base_url, attributes["URI"]), byte_range))
+            fmp4 = True
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            pending_range = _byte_range(line.partition(":")[2], last_end)
+            last_end = pending_range[1]
+        elif not line.startswith("#"):
+            fragments.append(Fragment(urljoin(base_url, line), pending_range))
+            pending_range = None
+    if "#EXT-X-ENDLIST" not in playlist:
+        raise unsupported("Live streams are not supported")
+    if not fragments:
+        raise unsupported("The playlist has no segments")
+    # Without an EXT-X-MAP the segments are MPEG-TS, which concatenate as is
+    return FragmentPlan(fragments, "mp4", "video/mp4") if fmp4 else FragmentPlan(fragments, "ts", "video/mp2t")
+
+
+# --- DASH --------------------------------------------------------------------
+
+DURATION_RE = re.compile(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?")
+TEMPLATE_RE = re.compile(r"\$(RepresentationID|Number|Time|Bandwidth)(%0(\d+)d)?\$")
+MIME_EXTENSIONS = {"video/mp4": "mp4", "audio/mp4": "m4a", "video/webm": "webm", "audio/webm": "webm"}
+
+
+def _local(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def _child(element: Optional[ET.Element], name: str) -> Optional[ET.Element]:
+    if element is None:
+        return None
+    return next((c for c in element if _local(c.tag) == name), None)
+
+
+def _children(element: ET.Element, name: str) -> List[ET.Element]:
+    return [c for c in element if _local(c.tag) == name]
+
+
+def _seconds(duration: Optional[str]) -> float:
+    match = DURATION_RE.fullmatch(duration or "")
+    if not match:
+        return 0.0
+    days, hours, minutes, seconds = (float(g or 0) for g in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _base_url(base: str, element: ET.Element) -> str:
+    child = _child(element, "BaseURL")
+    return urljoin(base, child.text.strip()) if child is not None and child.text else base
+
+
+def _fill(template: str, representation: ET.Element, number: int = 0, time: int = 0) -> str:
+    values = {"RepresentationID": representation.get("id", ""), "Number": number,
+              "Time": time, "Bandwidth": representation.get("bandwidth", "")}
+
+    def substitute(match):
+        value = values[match.group(1)]
+        return str(value).zfill(int(match.group(3))) if match.group(3) else str(value)
+
+    return TEMPLATE_RE.sub(substitute, template).replace("$$", "$")
+
+
+def _inherited(levels: List[ET.Element], name: str) -> Optional[ET.Element]:
+    # SegmentTemplate/SegmentList may sit on the Representation or any parent;
+    # the closest one wins, attributes are merged outwards-in
+    found = [e for e in (_child(level, name) for level in levels) if e is not None]
+    if not found:
+        return None
+    merged = ET.Element(name)
+    for element in reversed(found):
+        merged.attrib.update(element.attrib)
+    taken = set()
+    for element in found:
+        tags = {_local(child.tag) for child in element} - taken
+        merged.extend(child for child in element if _local(child.tag) in tags)
+        taken |= tags
+    return merged
+
+
+def _template_fragments(template: ET.Element, representation: ET.Element, base: str, period_seconds: float):
+    fragments = []
+    if template.get("initialization"):
+        fragments.append(Fragment(urljoin(base, _fill(template.get("initialization"), representation))))
+    media = template.get("media")
+    if not media:
+        raise unsupported("Unsupported DASH manifest")
+    number = int(template.get("startNumber", "1"))
+    timescale = int(template.get("timescale", "1"))
+    timeline = _child(template, "SegmentTimeline")
+    if timeline is not None:
+        entries = _children(timeline, "S")
+        period_end = int(template.get("presentationTimeOffset", "0")) + int(period_seconds * timescale)
+        time = 0
+        for i, s in enumerate(entries):
+            time = int(s.get("t", time))
+            duration = int(s.get("d"))
+            repeat = int(s.get("r", "0"))
+            if repeat < 0:
+                # Repeats up to the next S@t, or else to the end of the Period
+                following = entries[i + 1].get("t") if i + 1 < len(entries) else None
+                end = int(following) if following is not None else period_end
+                repeat = -(-(end - time) // duration) - 1  # ceil
+            for _ in range(repeat + 1):
+                fragments.append(Fragment(urljoin(base, _fill(media, representation, number, time))))
+                time += duration
+                number += 1
+        return fragments
+    duration = int(template.get("duration", "0"))
+    if not duration or not period_seconds:
+        raise unsupported("Unsupported DASH manifest")
+    count = -(-int(period_seconds * timescale) // duration)  # ceil
+    for i in range(count):
+        fragments.append(Fragment(urljoin(base, _fill(media, representation, number + i, i * duration))))
+    return fragments
+
+
+def _list_fragments(segment_list: ET.Element, base: str):
+    fragments = []
+    initialization = _child(segment_list, "Initialization")
+    if initialization is not None:
+        fragments.append(Fragment(urljoin(base, initialization.get("sourceURL", "")),
+                                  _range_attribute(initialization.get("range"))))
+    for segment in _children(segment_list, "SegmentURL"):
+        fragments.append(Fragment(urljoin(base, segment.get("media", "")),
+                                  _range_attribute(segment.get("mediaRange"))))
+    return fragments
+
+
+def _range_attribute(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    if not value:
+        return None
+    start, _, end = value.partition("-")
+    return int(start), int(end)
+
+
+def _period_seconds(periods: List[ET.Element], index: int, total_seconds: float) -> float:
+    # Period@duration, else up to the next Period@start or the end of the
+    # presentation
+    period = periods[index]
+    if period.get("duration"):
+        return _seconds(period.get("duration"))
+    start = _seconds(period.get("start"))
+    following = periods[index + 1].get("start") if index + 1 < len(periods) else None
+    end = _seconds(following) if following else total_seconds
+    return max(end - start, 0.0)
+
+
+def parse_mpd(manifest: str, base_url: str, representation_id: str) -> FragmentPlan:
+    # Fragments of one Representation across every Period of a static MPD.
+    # yt-dlp prefixes the format id with the MPD id ("dash-<id>"), so either
+    # form matches.
+    try:
+        root = ET.fromstring(manifest)
+    except ET.ParseError:
+        raise unsupported("Not a DASH manifest")
+    if root.get("type") == "dynamic":
+        raise unsupported("Live streams are not supported")
+    total_seconds = _seconds(root.get("mediaPresentationDuration"))
+    mpd_base = _base_url(base_url, root)
+
+    fragments: List[Fragment] = []
+    mime_type = None
+    periods = _children(root, "Period")
+    for index, period in enumerate(periods):
+        period_base = _base_url(mpd_base, period)
+        period_seconds = _period_seconds(periods, index, total_seconds)
+        for adaptation in _children(period, "AdaptationSet"):
+            adaptation_base = _base_url(period_base, adaptation)
+            for representation in _children(adaptation, "Representation"):
+                rep_id = representation.get("id", "")
+                if representation_id != rep_id and not representation_id.endswith("-" + rep_id):
+                    continue
+                mime_type = representation.get("mimeType") or adaptation.get("mimeType") or mime_type
+                base = _base_url(adaptation_base, representation)
+                levels = [representation, adaptation, period]
+                template = _inherited(levels, "SegmentTemplate")
+                segment_list = _inherited(levels, "SegmentList")
+                if template is not None:
+                    fragments += _template_fragments(template, representation, base, period_seconds)
+                elif segment_list is not None:
+                    fragments += _list_fragments(segment_list, base)
+                else:
+                    # SegmentBase or bare BaseURL: a single file
+                    fragments.append(Fragment(base))
+    if not fragments:
+        raise HTTPException(status_code=404, detail="Requested format is not available")
+    mime_type = mime_type or "video/mp4"
+    return FragmentPlan(fragments, MIME_EXTENSIONS.get(mime_type, "mp4"), mime_type)
+
+
+# --- Pipeline ----------------------------------------------------------------
+
+async def fetch_manifest(url: str, headers: Dict[str, str]) -> Tuple[str, str]:
+    # Manifest text plus its final URL, which relative fragment URIs resolve against
+    upstream = await upstream_pool.open(url, headers=headers)
+    try:
+        if upstream.response.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"Upstream returned {upstream.response.status_code}")
+        body = b""
+        async for chunk in upstream.response.aiter_bytes():
+            body += chunk
+            if len(body) > MANIFEST_MAX_BYTES:
+                raise unsupported("Manifest is too large")
+        return body.decode(upstream.response.encoding or "utf-8", "replace"), str(upstream.response.url)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream fetch failed: {e}")
+    finally:
+        await upstream.aclose()
+
+
+async def load_plan(
+    protocol: str, url: str, headers: Dict[str, str],
+    manifest_url: Optional[str] = None, format_id: Optional[str] = None,
+) -> FragmentPlan:
+    if protocol in HLS_PROTOCOLS:
+        playlist, base = await fetch_manifest(url, headers)
+        variant = best_variant(playlist, base)
+        if variant is not None:
+            # Given the master playlist (the record's own url): take the best
+            playlist, base = await fetch_manifest(variant, headers)
+        return parse_m3u8(playlist, base)
+    if protocol in DASH_PROTOCOLS:
+        manifest, base = await fetch_manifest(manifest_url or url, headers)
+        return parse_mpd(manifest, base, format_id or "")
+    raise unsupported(f"Unsupported protocol {protocol}")
+
+
+async def reserve_fragments(plan: FragmentPlan) -> Optional[SlotReservation]:
+    # Slots on the fragments' host, taken before any header is sent: waits
+    # for at least one (503 on timeout), so fetching never has to
+    if not plan.fragments:
+        return None
+    return await upstream_pool.reserve(plan.fragments[0].url, FRAGMENT_CONCURRENCY, wait=True)
+
+
+def fetch_fragments(
+    plan: FragmentPlan, headers: Dict[str, str], reservation: Optional[SlotReservation] = None
+) -> InOrder:
+    fragment_stats["downloads"] += 1
+    return InOrder(
+        (
+            partial(fetch_bytes, f.url, headers, f.byte_range, upstream_pool, fragment_stats, reservation)
+            for f in plan.fragments
+        ),
+        reservation.count if reservation is not None else FRAGMENT_CONCURRENCY,
+    )
+
+
+async def stream_fragments(
+    protocol: str,
+    url: str,
+    title: str,
+    headers: Optional[Dict[str, str]] = None,
+    manifest_url: Optional[str] = None,
+    format_id: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+    method: str = "GET",
+) -> Response:
+    # HLS/DASH renditions: fragments are fetched FRAGMENT_CONCURRENCY at a
+    # time and joined in order into one download, entirely in memory. The
+    # total size is unknown up front, so there is no Content-Length or Range
+    # support and the byte cap is applied while streaming.
+    request_headers = {**(headers or {}), "Accept-Encoding": "identity"}
+    plan = await load_plan(protocol, url, request_headers, manifest_url, format_id)
+    response_headers = download_headers(f"{title}.{plan.ext}")
+    if method == "HEAD":
+        return Response(media_type=plan.media_type, headers=response_headers)
+
+    reservation = await reserve_fragments(plan)
+    fragments = fetch_fragments(plan, request_headers, reservation)
+
+    async def body():
+        sent = 0
+        try:
+            # A fragment that keeps failing, or passing the byte cap, raises
+            # here, aborting the response so the client sees a failed download
+            # rather than a short file
+            async for chunk in fragments.chunks():
+                sent += len(chunk)
+                if max_bytes is not None and sent > max_bytes:
+                    raise DownloadTooLarge(max_bytes)
+                yield chunk
+        finally:
+            try:
+                await fragments.aclose()
+            finally:
+                if reservation is not None:
+                    reservation.release()
+
+    return StreamingResponse(body(), media_type=plan.media_type, headers=response_headers)
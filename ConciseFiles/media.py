@@ -0,0 +1,194 @@
+# media.py
+from typing import List, Optional
+
+from urls import url_expiry
+
+# Formats we can relay as a single plain HTTP download
+DIRECT_PROTOCOLS = ("http", "https")
+# Formats served by joining fragments listed in a manifest (fragments.py)
+HLS_PROTOCOLS = ("m3u8", "m3u8_native")
+DASH_PROTOCOLS = ("http_dash_segments",)
+FRAGMENTED_PROTOCOLS = HLS_PROTOCOLS + DASH_PROTOCOLS
+# Served for audio-only files; CDNs often label them video/*
+AUDIO_MEDIA_TYPES = {
+    "m4a": "audio/mp4", "mp4": "audio/mp4", "aac": "audio/aac", "mp3": "audio/mpeg",
+    "webm": "audio/webm", "weba": "audio/webm", "ogg": "audio/ogg", "opus": "audio/ogg",
+}
+
+
+# Base for the compact records below: fixed __slots__ instead of a per-object
+# __dict__, plus a plain-dict form for JSON (Redis, single-flight results)
+class _Record:
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, data.get(name))
+        return record
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Format(_Record):
+    __slots__ = (
+        "format_id", "note", "url", "manifest_url", "ext", "protocol", "http_headers",
+        "vcodec", "acodec", "width", "height", "fps", "tbr", "abr",
+        "filesize", "filesize_approx",
+    )
+
+    @classmethod
+    def from_info(cls, info: dict, shared_headers: Optional[dict] = None) -> "Format":
+        fmt = cls.__new__(cls)
+        fmt.format_id = info.get("format_id")
+        fmt.note = info.get("format_note")
+        fmt.url = info.get("url")
+        fmt.manifest_url = info.get("manifest_url")
+        fmt.ext = info.get("ext")
+        fmt.protocol = info.get("protocol")
+        # Only kept when they differ from the record's, which they rarely do
+        headers = info.get("http_headers")
+        fmt.http_headers = dict(headers) if headers and headers != shared_headers else None
+        fmt.vcodec = info.get("vcodec")
+        fmt.acodec = info.get("acodec")
+        fmt.width = info.get("width")
+        fmt.height = info.get("height")
+        fmt.fps = info.get("fps")
+        fmt.tbr = info.get("tbr")
+        fmt.abr = info.get("abr")
+        fmt.filesize = info.get("filesize")
+        fmt.filesize_approx = info.get("filesize_approx")
+        return fmt
+
+    # yt-dlp uses "none" for a missing stream and None for "unknown"; unknown
+    # codecs on a direct file (common on Instagram) mean it carries both
+    @property
+    def has_video(self) -> bool:
+        return self.vcodec != "none"
+
+    @property
+    def has_audio(self) -> bool:
+        return self.acodec != "none"
+
+    @property
+    def muxed(self) -> bool:
+        return self.has_video and self.has_audio
+
+    @property
+    def size(self) -> Optional[int]:
+        return self.filesize or self.filesize_approx
+
+    @property
+    def resolution(self) -> str:
+        if not self.has_video:
+            return "audio only"
+        if self.width and self.height:
+            return f"{self.width}x{self.height}"
+        return f"{self.height}p" if self.height else ""
+
+    def describe(self) -> dict:
+        # Public listing entry for /video-info
+        return {
+            "format_id": self.format_id,
+            "ext": self.ext,
+            "resolution": self.resolution,
+            "height": self.height,
+            "fps": self.fps,
+            "vcodec": self.vcodec if self.has_video else None,
+            "acodec": self.acodec if self.has_audio else None,
+            "filesize": self.size,
+            "filesize_approx": not self.filesize and bool(self.filesize_approx),
+            "muxed": self.muxed,
+            "note": self.note,
+        }
+
+
+# Everything the app serves about one post, projected out of yt-dlp's info
+# dict as soon as extraction finishes so the full dict (every format's
+# fragment list, thumbnail variants, raw page JSON...) is never kept
+class MediaRecord(_Record):
+    __slots__ = (
+        "id", "extractor", "title", "duration", "thumbnail",
+        "format", "format_id", "ext", "url", "manifest_url", "protocol", "http_headers",
+        "filesize", "expires_at", "formats", "requested_formats",
+    )
+
+    @classmethod
+    def from_info(cls, info: dict) -> "MediaRecord":
+        record = cls.__new__(cls)
+        record.id = info.get("id")
+        record.extractor = info.get("extractor_key")
+        record.title = info.get("title") or "video"
+        record.duration = info.get("duration") or 0
+        record.thumbnail = info.get("thumbnail") or ""
+        record.format = info.get("format") or ""
+        record.format_id = info.get("format_id")
+        record.ext = info.get("ext") or "mp4"
+        record.url = info.get("url")
+        record.manifest_url = info.get("manifest_url")
+        record.protocol = info.get("protocol")
+        # Plain dict: yt-dlp's HTTPHeaderDict does not survive pickling
+        # (process backend) and is not what the JSON form expects
+        headers = info.get("http_headers")
+        record.http_headers = dict(headers) if headers else None
+        record.filesize = info.get("filesize") or info.get("filesize_approx")
+        record.expires_at = url_expiry(record.url) if record.url else None
+        record.formats = [Format.from_info(f, record.http_headers) for f in info.get("formats") or ()]
+        record.requested_formats = [
+            Format.from_info(f, record.http_headers) for f in info.get("requested_formats") or ()
+        ]
+        return record
+
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        data["formats"] = [f.to_dict() for f in self.formats]
+        data["requested_formats"] = [f.to_dict() for f in self.requested_formats]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MediaRecord":
+        record = super().from_dict(data)
+        record.formats = [Format.from_dict(f) for f in data.get("formats") or ()]
+        record.requested_formats = [Format.from_dict(f) for f in data.get("requested_formats") or ()]
+        return record
+
+    def headers_for(self, fmt: Optional[Format] = None) -> Optional[dict]:
+        if fmt is not None and fmt.http_headers:
+            return fmt.http_headers
+        return self.http_headers
+
+    def source(self, fmt: Optional[Format] = None) -> dict:
+        # What is needed to fetch one rendition (the record's own when no
+        # format is given), in the shape download tokens sign
+        chosen = fmt if fmt is not None else self
+        source = {'url': chosen.url, 'protocol': chosen.protocol, 'headers': self.headers_for(fmt)}
+        if fmt is not None and not fmt.has_video:
+            source['media_type'] = AUDIO_MEDIA_TYPES.get(fmt.ext)
+        if chosen.protocol in DASH_PROTOCOLS:
+            # The fragment list is too long to carry; the MPD is fetched again
+            source['manifest_url'] = chosen.manifest_url
+            source['format_id'] = chosen.format_id
+        return source
+
+    def get_format(self, format_id: str) -> Optional[Format]:
+        return next((f for f in self.usable_formats() if f.format_id == format_id), None)
+
+    def usable_formats(self) -> List[Format]:
+        # Direct and HLS/DASH renditions (no storyboards or image tracks);
+        # muxed first, then best first, a direct file before a fragmented
+        # one of the same height
+        usable = [
+            f for f in self.formats
+            if f.url and f.protocol in DIRECT_PROTOCOLS + FRAGMENTED_PROTOCOLS
+            and (f.has_video or f.has_audio) and f.ext != "mhtml"
+        ]
+        return sorted(
+            usable,
+            key=lambda f: (f.muxed, f.has_video, f.height or 0, f.protocol in DIRECT_PROTOCOLS, f.tbr or 0),
+            reverse=True,
+        )
@@ -0,0 +1,321 @@
+# remux.py
+import asyncio
+import logging
+import os
+import shutil
+from typing import AsyncIterator, List, Optional
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+from fragments import fetch_fragments, load_plan, reserve_fragments
+from media import FRAGMENTED_PROTOCOLS
+from streaming import (
+    CHUNK_SIZE, DownloadTooLarge, InOrder, SlotReservation, UpstreamStream, download_headers, upstream_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+# ffmpeg processes running at once; with -c copy each is mostly I/O, but
+# still a process and a core's worth of demuxing
+REMUX_SLOTS = int(os.environ.get("REMUX_SLOTS", str(os.cpu_count() or 2)))
+REMUX_QUEUE_TIMEOUT = float(os.environ.get("REMUX_QUEUE_TIMEOUT", "10"))
+# Tail of ffmpeg's stderr kept for the log when it fails
+STDERR_TAIL = 4096
+
+# Fragmented MP4 can be written to a pipe: the moov box comes first and
+# every fragment is self-contained, so no seeking back is needed
+MP4_OUTPUT = ("-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof")
+WEBM_OUTPUT = ("-f", "webm")
+MEDIA_TYPES = {"mp4": "video/mp4", "webm": "video/webm"}
+# Audio-only outputs by extension (see formats.demuxed_ext)
+AUDIO_OUTPUTS = {
+    "aac": (("-f", "adts"), "audio/aac"),
+    "mp3": (("-f", "mp3"), "audio/mpeg"),
+    "webm": (("-f", "webm"), "audio/webm"),
+}
+
+
+class RemuxInput:
+    # One rendition feeding ffmpeg, opened before the response starts: a
+    # direct file's upstream response, or an HLS/DASH rendition's fragment
+    # fetches and their reserved slots
+    def __init__(
+        self,
+        upstream: Optional[UpstreamStream] = None,
+        fragments: Optional[InOrder] = None,
+        reservation: Optional[SlotReservation] = None,
+    ):
+        self.upstream = upstream
+        self.fragments = fragments
+        self.reservation = reservation
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        try:
+            if self.fragments is not None:
+                async for chunk in self.fragments.chunks():
+                    yield chunk
+            else:
+                async for chunk in self.upstream.response.aiter_raw(CHUNK_SIZE):
+                    yield chunk
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        try:
+            if self.fragments is not None:
+                await self.fragments.aclose()
+            if self.upstream is not None:
+                await self.upstream.aclose()
+        finally:
+            if self.reservation is not None:
+                self.reservation.release()
+
+
+async def open_input(source: dict) -> RemuxInput:
+    # One rendition as signed in a download token (see MediaRecord.source).
+    # An expired URL, a failed manifest or a full pool is an HTTP error here,
+    # like in stream_upstream, rather than a 200 whose body aborts.
+    headers = {**(source.get('headers') or {}), "Accept-Encoding": "identity"}
+    if source.get('protocol') in FRAGMENTED_PROTOCOLS:
+        plan = await load_plan(
+            source['protocol'], source['url'], headers, source.get('manifest_url'), source.get('format_id')
+        )
+        reservation = await reserve_fragments(plan)
+        return RemuxInput(fragments=fetch_fragments(plan, headers, reservation), reservation=reservation)
+    try:
+        upstream = await upstream_pool.open(source['url'], headers=headers)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream fetch failed: {e}")
+    if upstream.response.status_code >= 400:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail=f"Upstream returned {upstream.response.status_code}")
+    return RemuxInput(upstream=upstream)
+
+
+async def _pump(chunks: AsyncIterator[bytes], writer: asyncio.StreamWriter) -> None:
+    # Feeds one input into ffmpeg; closing the pipe is its end of file
+    try:
+        async for chunk in chunks:
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg exited or stopped reading; its exit status tells why
+    finally:
+        await chunks.aclose()
+        writer.close()
+
+
+async def _pipe_writer(fd: int) -> asyncio.StreamWriter:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, os.fdopen(fd, "wb", buffering=0)
+    )
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+class RemuxJob:
+    # One running ffmpeg: its process, its inputs and the tasks feeding
+    # them in, and its slot
+    def __init__(
+        self,
+        remuxer: "Remuxer",
+        process: asyncio.subprocess.Process,
+        inputs: List[RemuxInput],
+        pumps: List[asyncio.Task],
+    ):
+        self._remuxer = remuxer
+        self.process = process
+        self._inputs = inputs
+        self._pumps = pumps
+        self._stderr = asyncio.ensure_future(process.stderr.read())
+        self._closed = False
+
+    async def output(self, max_bytes: Optional[int] = None) -> AsyncIterator[bytes]:
+        sent = 0
+        try:
+            while True:
+                chunk = await self.process.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                if max_bytes is not None and sent > max_bytes:
+                    raise DownloadTooLarge(max_bytes)
+                yield chunk
+            returncode = await self.process.wait()
+            if returncode != 0:
+                stderr = (await self._stderr)[-STDERR_TAIL:].decode(errors="replace")
+                self._remuxer.failed += 1
+                logger.error("ffmpeg exited with %s: %s", returncode, stderr)
+                # Headers are already sent: abort the response rather than
+                # end a truncated file cleanly
+                raise RuntimeError(f"ffmpeg exited with {returncode}")
+            for pump in self._pumps:
+                # An input that failed to download surfaces here
+                await pump
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            for pump in self._pumps:
+                pump.cancel()
+            # The inputs' upstreams are closed by the time an abort
+            # (ffmpeg failing, the byte cap) leaves output(), also those of
+            # a pump cancelled before it started reading
+            await asyncio.gather(*self._pumps, return_exceptions=True)
+            for source in self._inputs:
+                await source.aclose()
+            if self.process.returncode is None:
+                self.process.kill()
+                await self.process.wait()
+            self._stderr.cancel()
+        finally:
+            self._remuxer._release()
+
+
+# Pipes upstream renditions through ffmpeg with -c copy (no transcoding, no
+# temp files) and streams its output: merging separate video and audio, or
+# demuxing the audio of a muxed file. The first input is ffmpeg's stdin, the
+# others extra pipes it reads as pipe:<fd>. At most REMUX_SLOTS run at once;
+# callers beyond that wait up to REMUX_QUEUE_TIMEOUT, then get a 503. The
+# inputs are opened before the response starts, so only failures after that
+# abort its body.
+class Remuxer:
+    def __init__(
+        self,
+        binary: str = FFMPEG_BINARY,
+        slots: int = REMUX_SLOTS,
+        queue_timeout: float = REMUX_QUEUE_TIMEOUT,
+    ):
+        self.binary = shutil.which(binary)
+        self.slots = slots
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(slots)
+        self.in_use = 0
+        self.started = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def available(self) -> bool:
+        return self.binary is not None
+
+    def _release(self) -> None:
+        self.in_use -= 1
+        self._slots.release()
+
+    async def run(self, inputs: List[dict], args: List[str]) -> RemuxJob:
+        if not self.available:
+            raise HTTPException(status_code=501, detail="This server cannot merge or convert media")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many downloads in progress, try again shortly")
+        self.in_use += 1
+        opened: List[RemuxInput] = []
+        try:
+            for source in inputs:
+                opened.append(await open_input(source))
+        except BaseException:
+            for source in opened:
+                await source.aclose()
+            self._release()
+            raise
+
+        pipes = [os.pipe() for _ in inputs[1:]]
+        command = [self.binary, "-hide_banner", "-nostats", "-loglevel", "error", "-i", "pipe:0"]
+        for read_fd, _ in pipes:
+            command += ["-i", f"pipe:{read_fd}"]
+        command += list(args) + ["pipe:1"]
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                pass_fds=[read_fd for read_fd, _ in pipes],
+            )
+        except BaseException:
+            for _, write_fd in pipes:
+                os.close(write_fd)
+            for source in opened:
+                await source.aclose()
+            self._release()
+            raise
+        finally:
+            # The child has its own copies of the read ends
+            for read_fd, _ in pipes:
+                os.close(read_fd)
+        self.started += 1
+
+        writers = [process.stdin] + [await _pipe_writer(write_fd) for _, write_fd in pipes]
+        pumps = [
+            asyncio.ensure_future(_pump(source.chunks(), writer))
+            for source, writer in zip(opened, writers)
+        ]
+        return RemuxJob(self, process, opened, pumps)
+
+    async def stream(
+        self,
+        inputs: List[dict],
+        args: List[str],
+        filename: str,
+        media_type: str,
+        max_bytes: Optional[int] = None,
+        method: str = "GET",
+    ) -> Response:
+        # Output size is only known at the end: no Content-Length or Range
+        headers = download_headers(filename)
+        if method == "HEAD":
+            if not self.available:
+                raise HTTPException(status_code=501, detail="This server cannot merge or convert media")
+            return Response(media_type=media_type, headers=headers)
+        job = await self.run(inputs, args)
+        return StreamingResponse(
+            job.output(max_bytes),
+            media_type=media_type,
+            headers=headers,
+            background=BackgroundTask(job.aclose),
+        )
+
+    async def merge(
+        self, video: dict, audio: dict, title: str, ext: str,
+        max_bytes: Optional[int] = None, method: str = "GET",
+    ) -> Response:
+        # bestvideo+bestaudio into one file, streams copied as they are
+        output = MP4_OUTPUT if ext == "mp4" else WEBM_OUTPUT
+        args = ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy", *output]
+        return await self.stream(
+            [video, audio], args, f"{title}.{ext}", MEDIA_TYPES.get(ext, "video/mp4"), max_bytes, method
+        )
+
+    async def extract_audio(
+        self, source: dict, title: str, ext: str,
+        max_bytes: Optional[int] = None, method: str = "GET",
+    ) -> Response:
+        # The audio stream of a muxed file, copied out as it is; the video
+        # is read from upstream but never sent to the client
+        output, media_type = AUDIO_OUTPUTS.get(ext, AUDIO_OUTPUTS["aac"])
+        args = ["-map", "0:a:0", "-vn", "-c", "copy", *output]
+        return await self.stream([source], args, f"{title}.{ext}", media_type, max_bytes, method)
+
+    def stats(self) -> dict:
+        return {
+            "available": self.available,
+            "slots": self.slots,
+            "in_use": self.in_use,
+            "started": self.started,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+remuxer = Remuxer()
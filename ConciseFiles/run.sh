@@ -24,4 +24,5 @@ sleep 2  # Wait for Redis to start
 
 # Start the FastAPI application
 echo "Starting FastAPI application..."
+export REDIS_URL="${REDIS_URL:-redis://localhost:6379/0}"
 uvicorn app:app --reload --host 0.0.0.0 --port 8000 
\ No newline at end of file
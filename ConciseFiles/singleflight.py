@@ -0,0 +1,170 @@
+# singleflight.py
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import ujson
+
+from cache import RedisBackend, RedisError
+
+logger = logging.getLogger(__name__)
+
+# How long one worker may hold the extraction lock for a key, and how long
+# the others wait for its result before extracting themselves
+FLIGHT_LOCK_TTL = float(os.environ.get("FLIGHT_LOCK_TTL", "60"))
+# Late waiters that subscribe after the result was published read it from here
+FLIGHT_RESULT_TTL = 30
+
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlightError(Exception):
+    # Raised in waiters when the worker that ran the call failed
+    pass
+
+
+# Collapses concurrent calls for the same key into one. Within a worker the
+# first caller starts the call as a task and everyone else awaits that task.
+# With Redis, the workers also elect a single leader per key through a lock
+# and the rest receive its JSON result on a pub/sub channel.
+class SingleFlight:
+    def __init__(
+        self,
+        redis: Optional[RedisBackend] = None,
+        prefix: str = "flight:",
+        encode: Callable[[Any], Any] = lambda value: value,
+        decode: Callable[[Any], Any] = lambda value: value,
+        encode_error: Callable[[Exception], Any] = str,
+        decode_error: Callable[[Any], Exception] = SingleFlightError,
+        retain_error: Callable[[Exception], bool] = lambda e: True,
+    ):
+        # encode/decode convert results to and from their JSON form for Redis,
+        # encode_error/decode_error the leader's exception. An error is always
+        # published to the current waiters, but only kept for late ones when
+        # retain_error says it is worth repeating.
+        self.redis = redis
+        self.prefix = prefix
+        self.encode = encode
+        self.decode = decode
+        self.encode_error = encode_error
+        self.decode_error = decode_error
+        self.retain_error = retain_error
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.shared_local = 0
+        self.shared_remote = 0
+        self.remote_timeouts = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, fn))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.shared_local += 1
+        # Shielded so a disconnecting client does not cancel the call for
+        # everyone else waiting on it
+        return await asyncio.shield(task)
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        client = self.redis.client if self.redis is not None else None
+        if client is None:
+            self.calls += 1
+            return await fn()
+
+        lock_key = f"{self.prefix}lock:{key}"
+        result_key = f"{self.prefix}result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            leader = await client.set(lock_key, token, nx=True, px=int(FLIGHT_LOCK_TTL * 1000))
+        except RedisError as e:
+            logger.warning("Single-flight lock unavailable: %s", e)
+            self.calls += 1
+            return await fn()
+
+        if not leader:
+            message = await self._wait_for_leader(client, lock_key, result_key)
+            if message is not None:
+                self.shared_remote += 1
+                if "error" in message:
+                    raise self.decode_error(message["error"])
+                return self.decode(message["ok"])
+            self.remote_timeouts += 1
+
+        self.calls += 1
+        try:
+            result = await fn()
+        except Exception as e:
+            if leader:
+                await self._publish(
+                    client, result_key, {"error": self.encode_error(e)}, store=self.retain_error(e)
+                )
+            raise
+        else:
+            if leader:
+                await self._publish(client, result_key, {"ok": self.encode(result)})
+        finally:
+            # Only after publishing: a waiter that sees the lock gone with no
+            # result takes the leader for crashed and extracts itself
+            if leader:
+                try:
+                    await client.eval(_RELEASE_LOCK, 1, lock_key, token)
+                except RedisError:
+                    pass
+        return result
+
+    async def _publish(self, client, result_key: str, message: dict, store: bool = True) -> None:
+        try:
+            payload = ujson.dumps(message)
+            if store:
+                await client.set(result_key, payload, ex=FLIGHT_RESULT_TTL)
+            await client.publish(result_key, payload)
+        except (RedisError, TypeError, OverflowError) as e:
+            logger.warning("Could not publish single-flight result: %s", e)
+
+    async def _wait_for_leader(self, client, lock_key: str, result_key: str) -> Optional[dict]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + FLIGHT_LOCK_TTL
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(result_key)
+            # The leader may have finished before we subscribed
+            raw = await client.get(result_key)
+            while raw is None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 1.0))
+                if message is not None:
+                    raw = message["data"]
+                elif not await client.exists(lock_key):
+                    # Leader gave up without publishing (crashed or timed out)
+                    raw = await client.get(result_key)
+                    if raw is None:
+                        return None
+            return ujson.loads(raw)
+        except RedisError as e:
+            logger.warning("Single-flight wait failed: %s", e)
+            return None
+        finally:
+            try:
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "shared_local": self.shared_local,
+            "shared_remote": self.shared_remote,
+            "remote_timeouts": self.remote_timeouts,
+        }
@@ -85,6 +85,36 @@ async function showError(message) {
     alert(message);
 }
 
+function formatSize(bytes) {
+    const units = ["B", "KB", "MB", "GB"];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+
+// One download link per quality option; each carries its own signed token
+function renderFormats(formats, audio) {
+    const list = $("#video-formats").empty();
+    if (audio && audio.token) {
+        let label = `Audio only ${audio.ext}`;
+        if (audio.filesize) label += ` · ~${formatSize(audio.filesize)}`;
+        $("<li>").append(
+            $("<a>").attr("href", `/download?token=${encodeURIComponent(audio.token)}`).text(label)
+        ).appendTo(list);
+    }
+    formats.filter(f => f.token).forEach(f => {
+        let label = `${f.resolution} ${f.ext}`;
+        if (!f.muxed && f.vcodec) label += " (no audio)";
+        if (f.filesize) label += ` · ${f.filesize_approx ? "~" : ""}${formatSize(f.filesize)}`;
+        $("<li>").append(
+            $("<a>").attr("href", `/download?token=${encodeURIComponent(f.token)}`).text(label)
+        ).appendTo(list);
+    });
+}
+
 async function getVideoInfo(url) {
     try {
         const response = await fetch("/video-info", {
@@ -105,6 +135,7 @@ async function getVideoInfo(url) {
         $("#video-title").text(data.title);
         $("#video-duration").text(data.duration);
         $("#video-quality").text(data.format);
+        renderFormats(data.formats || [], data.audio);
         return data;
     } catch (error) {
         showError(error.message);
@@ -127,21 +158,16 @@ async function downloadVideo() {
     }
 
     try {
-        await getVideoInfo(url);
-        const response = await fetch("/download", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ url })
-        });
-
-        if (!response.ok) {
-            throw new Error((await response.json()).detail);
+        const data = await getVideoInfo(url);
+        if (!data.valid) {
+            throw new Error("Video duration should not exceed 2 minutes");
         }
-
-        const data = await response.json();
-        data.progress ? 
-            await updateProgress(parseFloat(data.progress)) :
-            showError(data.message);
+        if (!data.token) {
+            throw new Error("This video cannot be downloaded");
+        }
+        // Let the browser stream the file itself; the token carries the
+        // already-resolved media so the server does not extract it again
+        window.location.href = `/download?token=${encodeURIComponent(data.token)}`;
     } catch (error) {
         handleError(error);
     }
@@ -0,0 +1,514 @@
+# streaming.py
+import asyncio
+import os
+from collections import defaultdict, deque
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+try:
+    import h2  # noqa: F401 -- enables HTTP/2 in httpx when installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Size of each chunk relayed from the CDN to the client
+CHUNK_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT = httpx.Timeout(10.0, read=30.0)
+
+# Connection pool sizing for CDN fetches
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_PER_HOST = int(os.environ.get("UPSTREAM_MAX_PER_HOST", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+
+# Large objects are fetched as byte ranges over several pooled connections,
+# since CDNs commonly throttle each connection. At most SEGMENT_CONCURRENCY
+# segments are in flight or buffered per download. 1 disables it.
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", str(4 * 1024 * 1024)))
+SEGMENT_CONCURRENCY = int(os.environ.get("SEGMENT_CONCURRENCY", "4"))
+SEGMENT_RETRIES = int(os.environ.get("SEGMENT_RETRIES", "2"))
+# Slots per host a segmented download leaves free for plain ones, so a burst
+# of large downloads from one CDN host still gets UPSTREAM_MAX_PER_HOST of
+# them through rather than 503s
+SEGMENT_SPARE_SLOTS = int(os.environ.get("SEGMENT_SPARE_SLOTS", str(UPSTREAM_MAX_PER_HOST // 2)))
+
+# Upstream response headers passed through to the client
+FORWARDED_HEADERS = (
+    "content-length", "content-type", "content-encoding", "content-range",
+    "accept-ranges", "last-modified", "etag",
+)
+# Client request headers passed on to the CDN, so resumed downloads and
+# media seeking only fetch the missing bytes
+FORWARDED_REQUEST_HEADERS = ("range", "if-range")
+
+
+class UpstreamStream:
+    # An open upstream response holding one of its host's connection slots,
+    # its own or (slot None) one of a SlotReservation's
+    def __init__(self, response: httpx.Response, slot: Optional[asyncio.Semaphore], on_close):
+        self.response = response
+        self._slot = slot
+        self._on_close = on_close
+        self._closed = False
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self.response.aclose()
+        finally:
+            if self._slot is not None:
+                self._slot.release()
+            self._on_close()
+
+
+class SlotReservation:
+    # Connection slots on one host taken up front and held until released.
+    # Requests made with it never wait for (or time out on) the host's
+    # semaphore, so a response that is already streaming cannot fail for
+    # want of a slot. At most `count` of them may be open at once.
+    def __init__(self, host: str, slot: asyncio.Semaphore, count: int):
+        self.host = host
+        self.count = count
+        self._slot = slot
+
+    def release(self, keep: int = 0) -> None:
+        # Hands back all but `keep` of the slots
+        while self.count > keep:
+            self.count -= 1
+            self._slot.release()
+
+
+# Application-lifetime, keep-alive HTTP clients shared by every CDN fetch.
+# httpx caps the total pool; the per-host semaphores keep one busy CDN from
+# starving the others. Requests on a SlotReservation go through a second,
+# HTTP/1.1-only client: over HTTP/2 httpcore multiplexes every request to a
+# host onto one connection, and parallel ranges only beat a CDN's
+# per-connection throttling on connections of their own.
+class UpstreamPool:
+    def __init__(
+        self,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_per_host: int = UPSTREAM_MAX_PER_HOST,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+    ):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.keepalive_expiry = keepalive_expiry
+        self._client: Optional[httpx.AsyncClient] = None
+        self._parallel_client: Optional[httpx.AsyncClient] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._in_use: Dict[str, int] = defaultdict(int)
+        self.requests = 0
+        self.connections_opened = 0
+
+    def _new_client(self, http2: bool) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=http2,
+            timeout=UPSTREAM_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        self._client = self._new_client(HTTP2_AVAILABLE)
+        self._parallel_client = self._new_client(False)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            await self._parallel_client.aclose()
+            self._client = None
+            self._parallel_client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Upstream pool is not started")
+        return self._client
+
+    @property
+    def parallel_client(self) -> httpx.AsyncClient:
+        if self._parallel_client is None:
+            raise RuntimeError("Upstream pool is not started")
+        return self._parallel_client
+
+    async def _trace(self, event_name: str, info: dict) -> None:
+        # httpcore only connects when no idle keep-alive connection is available
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+    def _slot(self, host: str) -> asyncio.Semaphore:
+        return self._host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+
+    async def _acquire(self, slot: asyncio.Semaphore) -> None:
+        try:
+            await asyncio.wait_for(slot.acquire(), timeout=UPSTREAM_TIMEOUT.pool)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Too many downloads in progress, try again shortly")
+
+    async def reserve(
+        self, url: str, count: int, wait: bool = False, spare: int = 0
+    ) -> Optional[SlotReservation]:
+        # Up to `count` of the host's free slots beyond the first `spare`,
+        # without waiting for more. None when there are none, unless `wait`:
+        # then one is waited for like open() does (503 on timeout).
+        host = httpx.URL(url).host
+        slot = self._slot(host)
+        taken = 0
+        while taken < count + spare and not slot.locked():
+            await slot.acquire()  # a free slot: returns without suspending
+            taken += 1
+        for _ in range(min(spare, taken)):
+            slot.release()
+        taken = max(taken - spare, 0)
+        if not taken:
+            if not wait:
+                return None
+            await self._acquire(slot)
+            taken = 1
+        return SlotReservation(host, slot, taken)
+
+    async def open(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        method: str = "GET",
+        reservation: Optional[SlotReservation] = None,
+    ) -> UpstreamStream:
+        host = httpx.URL(url).host
+        if reservation is not None and reservation.host == host:
+            slot = None  # the caller keeps to the reservation's count
+        else:
+            slot = self._slot(host)
+            await self._acquire(slot)
+
+        self._in_use[host] += 1
+        self.requests += 1
+
+        def on_close():
+            self._in_use[host] -= 1
+            if not self._in_use[host]:
+                del self._in_use[host]
+
+        client = self.client if reservation is None else self.parallel_client
+        request = client.build_request(
+            method, url, headers=headers, extensions={"trace": self._trace}
+        )
+        try:
+            response = await client.send(request, stream=True)
+        except BaseException:
+            if slot is not None:
+                slot.release()
+            on_close()
+            raise
+        return UpstreamStream(response, slot, on_close)
+
+    def stats(self) -> dict:
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "max_connections": self.max_connections,
+            "max_per_host": self.max_per_host,
+            "in_use": sum(self._in_use.values()),
+            "in_use_by_host": dict(self._in_use),
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "connections_reused": max(self.requests - self.connections_opened, 0),
+        }
+
+
+upstream_pool = UpstreamPool()
+
+
+class SegmentError(Exception):
+    pass
+
+
+class DownloadTooLarge(Exception):
+    # Raised mid-stream when a download of unknown size passes its byte cap.
+    # The headers are already sent, so aborting the response is the only way
+    # to tell the client the file is incomplete.
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Download exceeded {max_bytes} bytes")
+
+
+segment_stats = {"downloads": 0, "segments": 0, "retries": 0, "failures": 0}
+
+
+async def fetch_bytes(
+    url: str,
+    headers: Dict[str, str],
+    byte_range: Optional[Tuple[int, int]] = None,
+    pool: UpstreamPool = upstream_pool,
+    stats: dict = segment_stats,
+    reservation: Optional[SlotReservation] = None,
+) -> bytes:
+    # One whole object or inclusive byte range, read into memory and retried
+    # on a fresh request when the CDN drops it. Runs while a response is
+    # already streaming, so every failure, including a full pool, ends in
+    # SegmentError (which aborts that response) rather than an HTTPException.
+    request_headers = dict(headers)
+    if byte_range is not None:
+        request_headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+    for attempt in range(SEGMENT_RETRIES + 1):
+        if attempt:
+            stats["retries"] += 1
+        try:
+            upstream = await pool.open(url, headers=request_headers, reservation=reservation)
+        except (httpx.HTTPError, HTTPException):
+            continue
+        try:
+            status = upstream.response.status_code
+            if status != (206 if byte_range is not None else 200):
+                if status < 500:
+                    break  # not going to change on a retry
+                continue
+            data = await upstream.response.aread()
+            if byte_range is None or len(data) == byte_range[1] - byte_range[0] + 1:
+                stats["segments"] += 1
+                return data
+        except httpx.HTTPError:
+            pass
+        finally:
+            await upstream.aclose()
+    stats["failures"] += 1
+    raise SegmentError(f"Fetching {url} failed after {attempt + 1} attempts")
+
+
+class InOrder:
+    # Runs up to `concurrency` fetches at once, starting as soon as it is
+    # created, and yields their results in order in CHUNK_SIZE pieces. The
+    # window of pending tasks is the reorder buffer, so memory is bounded by
+    # `concurrency` results.
+    def __init__(self, fetches: Iterator[Callable[[], Awaitable[bytes]]], concurrency: int):
+        self._fetches = fetches
+        self._concurrency = max(concurrency, 1)
+        self._window = deque()
+        self._schedule()
+
+    def _schedule(self) -> None:
+        while len(self._window) < self._concurrency:
+            fetch = next(self._fetches, None)
+            if fetch is None:
+                return
+            self._window.append(asyncio.ensure_future(fetch()))
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        try:
+            while self._window:
+                data = await self._window[0]
+                self._window.popleft()
+                self._schedule()
+                view = memoryview(data)
+                for i in range(0, len(view), CHUNK_SIZE):
+                    yield bytes(view[i:i + CHUNK_SIZE])
+        finally:
+            self.cancel()
+
+    def cancel(self) -> None:
+        while self._window:
+            self._window.popleft().cancel()
+
+    async def aclose(self) -> None:
+        # cancel(), then waits for the fetches to close their upstreams, so
+        # their connections are back before the caller releases its slots
+        pending = list(self._window)
+        self.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def segmented_body(
+    first: UpstreamStream,
+    url: str,
+    headers: Dict[str, str],
+    total: int,
+    reservation: SlotReservation,
+    segment_size: int = SEGMENT_SIZE,
+    pool: UpstreamPool = upstream_pool,
+):
+    # `first` is the already-open response for bytes 0..segment_size-1, on one
+    # of the reserved slots. It is relayed as it arrives while the following
+    # segments download in the background on the others, and are yielded
+    # strictly in order.
+    segment_stats["downloads"] += 1
+    rest = InOrder(
+        (
+            partial(
+                fetch_bytes, url, headers, (start, min(start + segment_size, total) - 1),
+                pool, segment_stats, reservation,
+            )
+            for start in range(segment_size, total, segment_size)
+        ),
+        reservation.count - 1,
+    )
+    try:
+        async for chunk in first.response.aiter_raw(CHUNK_SIZE):
+            yield chunk
+        await first.aclose()
+        async for chunk in rest.chunks():
+            yield chunk
+    finally:
+        try:
+            await rest.aclose()
+            await first.aclose()
+        finally:
+            reservation.release()
+
+
+def content_disposition(filename: str) -> str:
+    # Latin-1 fallback for old clients plus the RFC 5987 form for everyone else
+    fallback = filename.encode("ascii", "ignore").decode().replace('"', "") or "video"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def download_headers(filename: str) -> Dict[str, str]:
+    # Headers every download response carries
+    return {
+        "Content-Disposition": content_disposition(filename),
+        "Cache-Control": "no-cache",
+        # Marks the body as already encoded so GZipMiddleware passes it through untouched
+        "content-encoding": "identity",
+    }
+
+
+def total_size(response: httpx.Response) -> Optional[int]:
+    # Size of the whole object, also for a 206 ("Content-Range: bytes 0-99/1234")
+    content_range = response.headers.get("content-range", "")
+    total = content_range.rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    length = response.headers.get("content-length", "")
+    return int(length) if response.status_code == 200 and length.isdigit() else None
+
+
+async def stream_upstream(
+    url: str,
+    filename: str,
+    headers: Optional[Dict[str, str]] = None,
+    max_bytes: Optional[int] = None,
+    client_headers: Optional[Mapping[str, str]] = None,
+    method: str = "GET",
+    media_type: Optional[str] = None,
+) -> Response:
+    base_headers = {**(headers or {}), "Accept-Encoding": "identity"}
+    request_headers = dict(base_headers)
+    for name in FORWARDED_REQUEST_HEADERS:
+        if client_headers is not None and name in client_headers:
+            request_headers[name] = client_headers[name]
+    # A plain full download asks for the first segment only; a 206 back means
+    # the CDN serves ranges and the rest can be fetched in parallel. All the
+    # slots that takes are reserved now, before any header is sent, so the
+    # body never waits for one; with fewer than two free on the host (past
+    # SEGMENT_SPARE_SLOTS) it is one plain stream instead.
+    reservation = None
+    if method == "GET" and "range" not in request_headers and SEGMENT_CONCURRENCY > 1:
+        reservation = await upstream_pool.reserve(url, SEGMENT_CONCURRENCY + 1, spare=SEGMENT_SPARE_SLOTS)
+        if reservation is not None and reservation.count < 2:
+            reservation.release()
+            reservation = None
+    if reservation is not None:
+        request_headers["Range"] = f"bytes=0-{SEGMENT_SIZE - 1}"
+    try:
+        upstream = await upstream_pool.open(url, headers=request_headers, method=method, reservation=reservation)
+        if reservation is not None and upstream.response.status_code == 206 and total_size(upstream.response) is None:
+            # "Content-Range: bytes 0-N/*": with the total unknown the rest
+            # cannot be split up, so ask for the whole object instead
+            await upstream.aclose()
+            reservation.release()
+            reservation = None
+            del request_headers["Range"]
+            upstream = await upstream_pool.open(url, headers=request_headers, method=method)
+    except BaseException as e:
+        if reservation is not None:
+            reservation.release()
+        if isinstance(e, httpx.HTTPError):
+            raise HTTPException(status_code=502, detail=f"Upstream fetch failed: {e}")
+        raise
+
+    async def close():
+        try:
+            await upstream.aclose()
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    response = upstream.response
+    if response.status_code >= 400 and response.status_code != 416:
+        await close()
+        raise HTTPException(status_code=502, detail=f"Upstream returned {response.status_code}")
+    if response.status_code == 416:
+        # Range past the end: an empty error answer, carrying only the
+        # object's real extent ("bytes */1234")
+        await close()
+        content_range = response.headers.get("content-range")
+        return Response(status_code=416, headers={"content-range": content_range} if content_range else None)
+
+    size = total_size(response)
+    if max_bytes is not None and size is not None and size > max_bytes:
+        await close()
+        raise HTTPException(status_code=413, detail="This video is too large to download")
+
+    response_headers = download_headers(filename)
+    # An upstream content-encoding replaces identity: the bytes are relayed as they are
+    response_headers.update(
+        (name, response.headers[name]) for name in FORWARDED_HEADERS if name in response.headers
+    )
+    status_code = response.status_code
+    if response.status_code == 206:
+        response_headers["accept-ranges"] = "bytes"
+    segmented = reservation is not None and response.status_code == 206
+    if segmented:
+        # The client asked for the whole object, so answer as a plain 200
+        status_code = 200
+        response_headers.pop("content-range", None)
+        response_headers["content-length"] = str(size)
+    media_type = media_type or response.headers.get("content-type", "application/octet-stream")
+    response_headers["content-type"] = media_type
+
+    if method == "HEAD":
+        await close()
+        return Response(status_code=response.status_code, media_type=media_type, headers=response_headers)
+
+    if segmented and size > SEGMENT_SIZE:
+        chunks = segmented_body(upstream, url, base_headers, size, reservation)
+    else:
+        if reservation is not None:
+            reservation.release(keep=1)  # the slot `upstream` is open on
+        chunks = response.aiter_raw(CHUNK_SIZE)
+
+    async def body():
+        sent = 0
+        try:
+            async for chunk in chunks:
+                sent += len(chunk)
+                if max_bytes is not None and sent > max_bytes:
+                    # Only reachable without a Content-Length
+                    raise DownloadTooLarge(max_bytes)
+                yield chunk
+        finally:
+            # Starlette skips the background task when the body raises, so a
+            # dropped upstream must give back its connection and slots here
+            try:
+                await chunks.aclose()  # cancels any segments still downloading
+            finally:
+                await close()
+
+    return StreamingResponse(
+        body(),
+        status_code=status_code,
+        media_type=media_type,
+        headers=response_headers,
+        background=BackgroundTask(close),
+    )
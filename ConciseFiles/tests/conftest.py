@@ -0,0 +1,8 @@
+# conftest.py
+# The app is a flat set of modules run from ConciseFiles; make them importable
+#
+#   cd ConciseFiles && python -m pytest tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
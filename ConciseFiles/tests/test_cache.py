@@ -0,0 +1,93 @@
+# test_cache.py
+import pytest
+
+import cache
+from cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_get_and_put(clock):
+    c = TTLCache(maxsize=4, default_ttl=10)
+    assert c.get("a") is None
+    assert c.get("a", "default") == "default"
+    c.put("a", 1)
+    assert c.get("a") == 1
+    assert len(c) == 1
+    assert (c.hits, c.misses) == (1, 2)
+
+
+def test_entries_expire_after_their_ttl(clock):
+    c = TTLCache(maxsize=4, default_ttl=10)
+    c.put("default", 1)
+    c.put("short", 2, ttl=2)
+    clock.now += 2
+    assert c.get("short") is None
+    assert c.get("default") == 1
+    clock.now += 8
+    assert c.get("default") is None
+    # Expired entries are dropped when read
+    assert len(c) == 0
+
+
+def test_zero_ttl_is_never_served(clock):
+    c = TTLCache(default_ttl=10)
+    c.put("a", 1, ttl=0)
+    assert c.get("a") is None
+
+
+def test_least_recently_used_is_evicted(clock):
+    c = TTLCache(maxsize=3, default_ttl=10)
+    for key in "abc":
+        c.put(key, key)
+    c.get("a")  # now most recent; b is the oldest
+    c.put("d", "d")
+    assert c.get("b") is None
+    assert [c.get(key) for key in "acd"] == ["a", "c", "d"]
+    assert c.evictions == 1
+
+
+def test_put_refreshes_recency_and_ttl(clock):
+    c = TTLCache(maxsize=2, default_ttl=10)
+    c.put("a", 1)
+    c.put("b", 2)
+    clock.now += 5
+    c.put("a", 3)
+    c.put("c", 4)
+    assert c.get("b") is None
+    clock.now += 9
+    assert c.get("a") == 3
+
+
+def test_pop_and_clear(clock):
+    c = TTLCache(default_ttl=10)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.pop("a") == 1
+    assert c.pop("a", "gone") == "gone"
+    c.clear()
+    assert len(c) == 0
+
+
+def test_purge_expired_only_drops_expired(clock):
+    c = TTLCache(default_ttl=10)
+    c.put("old", 1, ttl=1)
+    c.put("older", 2, ttl=2)
+    c.put("fresh", 3)
+    clock.now += 2
+    assert c.purge_expired() == 2
+    assert len(c) == 1
+    assert c.stats() == {"size": 1, "maxsize": 100, "hits": 0, "misses": 0, "evictions": 0}
@@ -0,0 +1,207 @@
+# test_fragments.py
+import pytest
+from fastapi import HTTPException
+
+from fragments import best_variant, parse_m3u8, parse_mpd
+
+BASE = "https://cdn.example.com/v/"
+
+
+def urls(plan):
+    return [f.url for f in plan.fragments]
+
+
+def ranges(plan):
+    return [f.byte_range for f in plan.fragments]
+
+
+# --- HLS ---------------------------------------------------------------------
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+
+high/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1200000
+https://other.example.com/mid.m3u8
+"""
+
+
+def test_best_variant_picks_highest_bandwidth():
+    assert best_variant(MASTER, BASE) == BASE + "high/index.m3u8"
+
+
+def test_best_variant_of_media_playlist_is_none():
+    assert best_variant("#EXTM3U\n#EXTINF:4,\nseg0.ts\n#EXT-X-ENDLIST\n", BASE) is None
+
+
+def test_m3u8_ts_segments():
+    plan = parse_m3u8(
+        "#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXTINF:4,\nseg0.ts\n#EXTINF:4,\n/abs/seg1.ts\n"
+        "#EXTINF:2,\nhttps://b.example.com/seg2.ts\n#EXT-X-ENDLIST\n",
+        BASE,
+    )
+    assert urls(plan) == [BASE + "seg0.ts", "https://cdn.example.com/abs/seg1.ts", "https://b.example.com/seg2.ts"]
+    assert ranges(plan) == [None, None, None]
+    assert (plan.ext, plan.media_type) == ("ts", "video/mp2t")
+
+
+def test_m3u8_byte_ranges_follow_on_without_offset():
+    plan = parse_m3u8(
+        "#EXTM3U\n#EXTINF:4,\n#EXT-X-BYTERANGE:1000@500\nall.ts\n"
+        "#EXTINF:4,\n#EXT-X-BYTERANGE:2000\nall.ts\n#EXTINF:4,\nother.ts\n#EXT-X-ENDLIST\n",
+        BASE,
+    )
+    assert ranges(plan) == [(500, 1499), (1500, 3499), None]
+
+
+def test_m3u8_map_is_fmp4_and_first():
+    plan = parse_m3u8(
+        '#EXTM3U\n#EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0"\n#EXTINF:4,\n#EXT-X-BYTERANGE:1000@720\n'
+        "media.mp4\n#EXT-X-ENDLIST\n",
+        BASE,
+    )
+    assert urls(plan) == [BASE + "init.mp4", BASE + "media.mp4"]
+    assert ranges(plan) == [(0, 719), (720, 1719)]
+    assert (plan.ext, plan.media_type) == ("mp4", "video/mp4")
+
+
+def test_m3u8_unencrypted_key_is_accepted():
+    plan = parse_m3u8("#EXTM3U\n#EXT-X-KEY:METHOD=NONE\n#EXTINF:4,\nseg0.ts\n#EXT-X-ENDLIST\n", BASE)
+    assert urls(plan) == [BASE + "seg0.ts"]
+
+
+@pytest.mark.parametrize("playlist", [
+    "not a playlist",
+    '#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="key"\n#EXTINF:4,\nseg0.ts\n#EXT-X-ENDLIST\n',
+    "#EXTM3U\n#EXTINF:4,\nseg0.ts\n",
+    "#EXTM3U\n#EXT-X-ENDLIST\n",
+])
+def test_m3u8_refused(playlist):
+    # Not HLS, encrypted, live, empty
+    with pytest.raises(HTTPException) as error:
+        parse_m3u8(playlist, BASE)
+    assert error.value.status_code == 422
+
+
+# --- DASH --------------------------------------------------------------------
+
+def mpd(body: str, duration: str = "PT20S", mpd_type: str = "static") -> str:
+    return (
+        '<?xml version="1.0"?>'
+        f'<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="{mpd_type}" mediaPresentationDuration="{duration}">'
+        f"{body}</MPD>"
+    )
+
+
+def test_mpd_template_with_number_and_duration():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet mimeType="audio/mp4">'
+        '<SegmentTemplate timescale="1000" duration="6000" startNumber="3" '
+        'initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number%05d$.m4s"/>'
+        '<Representation id="a1" bandwidth="128000"/></AdaptationSet></Period>'
+    ), BASE, "a1")
+    # 20 s in 6 s segments: 4, the last one short
+    assert urls(plan) == [BASE + "a1/init.mp4"] + [BASE + f"a1/{n:05d}.m4s" for n in range(3, 7)]
+    assert (plan.ext, plan.media_type) == ("m4a", "audio/mp4")
+
+
+def test_mpd_segment_timeline_time_and_repeat():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet mimeType="video/mp4"><Representation id="v1" bandwidth="1">'
+        '<SegmentTemplate media="t$Time$.m4s"><SegmentTimeline>'
+        '<S t="100" d="10" r="2"/><S d="5"/><S t="200" d="7"/>'
+        "</SegmentTimeline></SegmentTemplate></Representation></AdaptationSet></Period>"
+    ), BASE, "v1")
+    assert urls(plan) == [BASE + f"t{t}.m4s" for t in (100, 110, 120, 130, 200)]
+
+
+def test_mpd_segment_timeline_negative_repeat_runs_to_next_time():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet><Representation id="v1" bandwidth="1">'
+        '<SegmentTemplate media="$Number$.m4s" startNumber="0"><SegmentTimeline>'
+        '<S t="0" d="4" r="-1"/><S t="10" d="5"/>'
+        "</SegmentTimeline></SegmentTemplate></Representation></AdaptationSet></Period>"
+    ), BASE, "v1")
+    # 0, 4, 8 (the last one cut short at 10), then 10
+    assert urls(plan) == [BASE + f"{n}.m4s" for n in range(4)]
+
+
+def test_mpd_segment_timeline_negative_repeat_runs_to_period_end():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet><Representation id="v1" bandwidth="1">'
+        '<SegmentTemplate timescale="1000" presentationTimeOffset="5000" media="$Time$.m4s">'
+        '<SegmentTimeline><S t="5000" d="4000" r="-1"/></SegmentTimeline>'
+        "</SegmentTemplate></Representation></AdaptationSet></Period>"
+    ), BASE, "v1")
+    # 20 s from t=5000 in 4 s segments
+    assert urls(plan) == [BASE + f"{t}.m4s" for t in range(5000, 25000, 4000)]
+
+
+def test_mpd_inherited_template_and_base_urls():
+    plan = parse_mpd(mpd(
+        "<BaseURL>media/</BaseURL><Period><BaseURL>p1/</BaseURL>"
+        '<SegmentTemplate timescale="1" duration="10" media="$RepresentationID$-$Number$.m4s"/>'
+        '<AdaptationSet mimeType="video/webm"><BaseURL>video/</BaseURL>'
+        '<SegmentTemplate initialization="$RepresentationID$-init.webm" startNumber="0"/>'
+        '<Representation id="hd" bandwidth="1"/><Representation id="sd" bandwidth="1"/>'
+        "</AdaptationSet></Period>"
+    ), BASE, "dash-hd")
+    # media and duration from the Period, init and startNumber from the AdaptationSet
+    assert urls(plan) == [BASE + "media/p1/video/hd-init.webm", BASE + "media/p1/video/hd-0.m4s",
+                          BASE + "media/p1/video/hd-1.m4s"]
+    assert (plan.ext, plan.media_type) == ("webm", "video/webm")
+
+
+def test_mpd_segment_list_with_ranges():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet mimeType="audio/mp4"><Representation id="a"><SegmentList>'
+        '<Initialization sourceURL="a.mp4" range="0-99"/>'
+        '<SegmentURL media="a.mp4" mediaRange="100-4999"/><SegmentURL media="b.mp4"/>'
+        "</SegmentList></Representation></AdaptationSet></Period>"
+    ), BASE, "a")
+    assert urls(plan) == [BASE + "a.mp4", BASE + "a.mp4", BASE + "b.mp4"]
+    assert ranges(plan) == [(0, 99), (100, 4999), None]
+
+
+def test_mpd_single_file_representation():
+    plan = parse_mpd(mpd(
+        '<Period><AdaptationSet mimeType="video/mp4"><Representation id="v">'
+        '<BaseURL>https://other.example.com/v.mp4</BaseURL><SegmentBase indexRange="0-100"/>'
+        "</Representation></AdaptationSet></Period>"
+    ), BASE, "v")
+    assert urls(plan) == ["https://other.example.com/v.mp4"]
+    assert ranges(plan) == [None]
+
+
+def test_mpd_periods_are_joined_in_order():
+    period = (
+        '<Period {}><AdaptationSet><Representation id="v" bandwidth="1">'
+        '<SegmentTemplate duration="5" media="{}-$Number$.m4s"/></Representation></AdaptationSet></Period>'
+    )
+    plan = parse_mpd(mpd(
+        period.format('duration="PT10S"', "a") + period.format('start="PT10S"', "b")
+        + period.format('start="PT15S"', "c")
+    ), BASE, "v")
+    # 10 s, then 15 s - 10 s up to the next start, then the 5 s left of 20 s
+    assert urls(plan) == [BASE + name for name in ("a-1.m4s", "a-2.m4s", "b-1.m4s", "c-1.m4s")]
+
+
+def test_mpd_unknown_representation_is_404():
+    with pytest.raises(HTTPException) as error:
+        parse_mpd(mpd('<Period><AdaptationSet><Representation id="v"/></AdaptationSet></Period>'), BASE, "x")
+    assert error.value.status_code == 404
+
+
+@pytest.mark.parametrize("manifest", [
+    "<MPD",
+    mpd("<Period/>", mpd_type="dynamic"),
+    mpd('<Period><AdaptationSet><Representation id="v"><SegmentTemplate duration="4"/>'
+        "</Representation></AdaptationSet></Period>"),
+])
+def test_mpd_refused(manifest):
+    # Not XML, live, a template without media
+    with pytest.raises(HTTPException) as error:
+        parse_mpd(manifest, BASE, "v")
+    assert error.value.status_code == 422
@@ -0,0 +1,103 @@
+# test_urls.py
+import time
+
+import pytest
+
+from urls import canonical_key, clean_url, url_expiry
+
+# --- Canonical keys ----------------------------------------------------------
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.instagram.com/p/Cabc_12-3/",
+    "instagram.com/p/Cabc_12-3",
+    "https://instagram.com/p/Cabc_12-3/?igsh=MWx0&utm_source=ig_web_copy_link",
+    "https://m.instagram.com/someone/p/Cabc_12-3/#comments",
+    "https://instagram.com/reel/Cabc_12-3/",
+    "https://instagr.am/tv/Cabc_12-3",
+])
+def test_instagram_post_shapes_share_a_key(url):
+    assert canonical_key(url) == "instagram:Cabc_12-3"
+
+
+def test_instagram_story_key():
+    assert canonical_key("https://www.instagram.com/stories/some.one/3141592653589793/") == \
+        "instagram:3141592653589793"
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtube.com/watch?feature=share&v=dQw4w9WgXcQ&si=abc",
+    "https://m.youtube.com/watch?v=dQw4w9WgXcQ&t=42",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ",
+])
+def test_youtube_link_shapes_share_a_key(url):
+    assert canonical_key(url) == "youtube:dQw4w9WgXcQ"
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.facebook.com/someone/videos/1234567890/",
+    "https://www.facebook.com/reel/1234567890?mibextid=abc",
+    "https://m.facebook.com/watch/?v=1234567890",
+    "https://www.facebook.com/story.php?story_fbid=1234567890&id=1",
+])
+def test_facebook_link_shapes_share_a_key(url):
+    assert canonical_key(url) == "facebook:1234567890"
+
+
+def test_unrecognised_link_on_a_supported_site_keys_on_the_cleaned_url():
+    assert canonical_key("https://fb.watch/aBcD12/?mibextid=x") == "facebook:fb.watch/aBcD12"
+    assert canonical_key("https://www.instagram.com/someone/?hl=en") == "instagram:instagram.com/someone?hl=en"
+
+
+def test_unsupported_site_keys_on_the_cleaned_url():
+    assert canonical_key("HTTP://Www.Example.com/a/b/?z=1&utm_medium=x&a=2#frag") == \
+        "url:https://example.com/a/b?a=2&z=1"
+
+
+def test_clean_url_drops_credentials_port_and_trailing_slash():
+    assert clean_url("https://user:pw@www.example.com:8443/") == "https://example.com/"
+
+
+
+# --- Signed URL expiry -------------------------------------------------------
+
+
+@pytest.mark.parametrize("url, expires_at", [
+    # Instagram/Facebook: hex unix time
+    ("https://scontent.cdninstagram.com/v/t50/a.mp4?_nc_ht=x&oh=00_abc&oe=6553F100", 0x6553F100),
+    ("https://video.xx.fbcdn.net/v/a.mp4?OE=6553F100", 0x6553F100),
+    # googlevideo
+    ("https://rr1---sn-x.googlevideo.com/videoplayback?expire=1700000000&ei=abc", 1700000000),
+    ("https://rr1---sn-x.googlevideo.com/videoplayback/expire/1700000000/ei/abc/", 1700000000),
+    # CloudFront
+    ("https://d1.cloudfront.net/a.mp4?Expires=1700000000&Signature=x", 1700000000),
+    # S3 SigV4: X-Amz-Date is UTC, whatever the server's time zone
+    ("https://b.s3.amazonaws.com/a.mp4?X-Amz-Date=20231114T221320Z&X-Amz-Expires=600", 1700000000 + 600),
+])
+def test_url_expiry(url, expires_at):
+    assert url_expiry(url) == expires_at
+
+
+@pytest.mark.parametrize("url", [
+    "https://example.com/a.mp4",
+    "https://example.com/a.mp4?oe=zz",
+    "https://example.com/a.mp4?X-Amz-Date=yesterday&X-Amz-Expires=600",
+    "https://example.com/expire/soon/a.mp4",
+])
+def test_url_without_usable_expiry(url):
+    assert url_expiry(url) is None
+
+
+@pytest.mark.skipif(not hasattr(time, "tzset"), reason="time.tzset is not available")
+def test_s3_expiry_ignores_local_time_zone(monkeypatch):
+    monkeypatch.setenv("TZ", "America/Los_Angeles")
+    time.tzset()
+    try:
+        assert url_expiry("https://b.s3.amazonaws.com/a?X-Amz-Date=20231114T221320Z&X-Amz-Expires=1") == 1700000001
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,122 @@
+# tokens.py
+import logging
+import os
+import secrets
+import sys
+import time
+from typing import Optional
+
+from jose import ExpiredSignatureError, JWTError, jwt
+
+from cache import RedisBackend, RedisError
+from media import Format, MediaRecord
+from urls import url_expiry
+
+logger = logging.getLogger(__name__)
+
+TOKEN_ALGORITHM = "HS256"
+# Upper bound on token lifetime; tokens never outlive the signed CDN URL
+TOKEN_TTL = int(os.environ.get("DOWNLOAD_TOKEN_TTL", "900"))
+TOKEN_SECRET_KEY = "download-token-secret"
+
+
+def configured_workers() -> int:
+    # Worker count asked of uvicorn or gunicorn, through WEB_CONCURRENCY or
+    # --workers/-w on the command line (spawned workers inherit the parent's argv)
+    count = int(os.environ.get("WEB_CONCURRENCY") or 1)
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        name, _, value = arg.partition("=")
+        if name in ("--workers", "-w"):
+            value = value or (args[i + 1] if i + 1 < len(args) else "")
+            if value.isdigit():
+                count = max(count, int(value))
+    return count
+
+
+class InvalidToken(Exception):
+    def __init__(self, message: str, status_code: int = 401):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+# Signs the resolved media of a /video-info call into a short-lived token
+# that any worker or instance can verify and stream from, without touching
+# the cache or yt-dlp. All of them must share the secret: it comes from
+# DOWNLOAD_TOKEN_SECRET, else is agreed on through Redis, else (single
+# process only) generated locally; with several workers and neither,
+# startup fails.
+class DownloadTokens:
+    def __init__(self, secret: Optional[str] = os.environ.get("DOWNLOAD_TOKEN_SECRET")):
+        self.secret = secret
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+
+    async def start(self, redis: Optional[RedisBackend] = None) -> None:
+        if self.secret:
+            return
+        candidate = secrets.token_urlsafe(32)
+        if redis is not None and redis.client is not None:
+            try:
+                key = redis.prefix + TOKEN_SECRET_KEY
+                await redis.client.set(key, candidate, nx=True)
+                stored = await redis.client.get(key)
+                self.secret = stored.decode() if isinstance(stored, bytes) else stored
+                return
+            except RedisError as e:
+                logger.warning("Could not share download token secret through Redis: %s", e)
+        if configured_workers() > 1:
+            # Every other worker would reject this one's tokens with a 401
+            raise RuntimeError(
+                "Set DOWNLOAD_TOKEN_SECRET, or REDIS_URL to a reachable Redis, to run more than one worker"
+            )
+        logger.warning("DOWNLOAD_TOKEN_SECRET is not set; download tokens only work on this worker")
+        self.secret = candidate
+
+    def issue(
+        self, media: MediaRecord, fmt: Optional[Format] = None,
+        audio: Optional[Format] = None, ext: Optional[str] = None, extract_audio: bool = False,
+    ) -> str:
+        # For the record's own chosen format unless another one is given; with
+        # `audio`, for that video and audio pair merged into one `ext` file;
+        # with `extract_audio`, for the audio demuxed from it into an `ext` file
+        source = media.source(fmt)
+        if extract_audio:
+            source['extract_audio'] = True
+        expiries = [url_expiry(source['url']) if fmt is not None else media.expires_at]
+        claims = {
+            **source,
+            'title': media.title,
+            'ext': ext or (fmt.ext if fmt is not None else media.ext),
+            'size': fmt.size if fmt is not None else media.filesize,
+        }
+        if audio is not None:
+            claims['audio'] = media.source(audio)
+            claims['size'] = fmt.size + audio.size if fmt.size and audio.size else None
+            expiries.append(url_expiry(audio.url))
+        expires_at = time.time() + TOKEN_TTL
+        # Never outlives a signed CDN URL it points at
+        expires_at = min([expires_at] + [e for e in expiries if e])
+        claims['exp'] = int(expires_at)
+        self.issued += 1
+        return jwt.encode(claims, self.secret, algorithm=TOKEN_ALGORITHM)
+
+    def verify(self, token: str) -> dict:
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[TOKEN_ALGORITHM])
+        except ExpiredSignatureError:
+            self.rejected += 1
+            raise InvalidToken("Download link expired, please fetch the video again", status_code=410)
+        except JWTError:
+            self.rejected += 1
+            raise InvalidToken("Invalid download link")
+        self.verified += 1
+        return claims
+
+    def stats(self) -> dict:
+        return {"issued": self.issued, "verified": self.verified, "rejected": self.rejected}
+
+
+download_tokens = DownloadTokens()
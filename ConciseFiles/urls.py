@@ -0,0 +1,149 @@
+# urls.py
+import calendar
+import re
+import time
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = re.compile(
+    r"^(utm_\w+|igsh|igshid|img_index|si|feature|pp|fbclid|gclid|mibextid|rdid|share_url|ref|ref_src|s|t)$"
+)
+
+HOST_ALIASES = {
+    "instagram.com": "instagram",
+    "instagr.am": "instagram",
+    "youtube.com": "youtube",
+    "youtube-nocookie.com": "youtube",
+    "youtu.be": "youtube",
+    "facebook.com": "facebook",
+    "fb.com": "facebook",
+    "fb.watch": "facebook",
+}
+
+INSTAGRAM_PATH = re.compile(r"^/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)|^/stories/[\w.]+/(\d+)")
+YOUTUBE_PATH = re.compile(r"^/(?:shorts|embed|live|v)/([\w-]{11})")
+YOUTUBE_ID = re.compile(r"^[\w-]{11}$")
+FACEBOOK_PATH = re.compile(r"/(?:videos|reel|watch)/(?:[\w.-]+/)?(\d+)")
+
+
+# Front door for yt-dlp: the extractor for each supported link shape, so
+# extraction goes straight to it instead of testing all ~1,900 extractors.
+# fb.watch and share links are redirects, which the Generic extractor follows
+EXTRACTOR_ROUTES = {
+    "instagram": (
+        (re.compile(r"^[^/]+/stories/[\w.]+/\d+"), "InstagramStory"),
+        (re.compile(r"^[^/]+/(?:[\w.]+/)?(?:p|reels?|tv)/[\w-]+"), "Instagram"),
+    ),
+    "youtube": (
+        (re.compile(r"^[^/]+/(?:watch|shorts/|embed/|live/|v/)|^youtu\.be/[\w-]{11}$"), "Youtube"),
+    ),
+    "facebook": (
+        (re.compile(r"/reel/\d+"), "FacebookReel"),
+        (re.compile(r"/(?:videos|watch)(?:/|$)|/(?:story|permalink|video)\.php"), "Facebook"),
+        (re.compile(r"^fb\.watch/[\w-]+|^facebook\.com/share/"), "Generic"),
+    ),
+}
+
+
+class MediaKey(NamedTuple):
+    site: str
+    media_id: str
+
+    def __str__(self) -> str:
+        return f"{self.site}:{self.media_id}"
+
+
+def _host(netloc: str) -> str:
+    host = netloc.lower().rsplit("@", 1)[-1].split(":", 1)[0]
+    for prefix in ("www.", "m.", "mobile.", "web.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+
+def clean_url(url: str) -> str:
+    # Lower-cased host without www/m., no fragment, no tracking parameters
+    parts = urlsplit(url.strip())
+    if not parts.scheme:
+        parts = urlsplit("https://" + url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not TRACKING_PARAMS.match(k)]
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit(("https", _host(parts.netloc), path, urlencode(sorted(query)), ""))
+
+
+def media_key(url: str) -> Optional[MediaKey]:
+    # Maps every shape of link to one post onto a stable (site, media_id);
+    # None for hosts this service does not support
+    cleaned = urlsplit(clean_url(url))
+    site = HOST_ALIASES.get(cleaned.netloc)
+    if site is None:
+        return None
+    path = cleaned.path
+    query = dict(parse_qsl(cleaned.query))
+
+    if site == "instagram":
+        match = INSTAGRAM_PATH.match(path)
+        if match:
+            return MediaKey(site, match.group(1) or match.group(2))
+    elif site == "youtube":
+        if cleaned.netloc == "youtu.be" and YOUTUBE_ID.match(path.lstrip("/")):
+            return MediaKey(site, path.lstrip("/"))
+        match = YOUTUBE_PATH.match(path)
+        if match:
+            return MediaKey(site, match.group(1))
+        if YOUTUBE_ID.match(query.get("v", "")):
+            return MediaKey(site, query["v"])
+    elif site == "facebook":
+        match = FACEBOOK_PATH.search(path)
+        if match:
+            return MediaKey(site, match.group(1))
+        for param in ("v", "story_fbid"):
+            if query.get(param, "").isdigit():
+                return MediaKey(site, query[param])
+
+    # Recognised site but an unrecognised link shape (share redirects,
+    # fb.watch codes...): fall back to the cleaned URL itself
+    return MediaKey(site, cleaned.netloc + path + ("?" + cleaned.query if cleaned.query else ""))
+
+
+def extractor_key(url: str) -> Optional[str]:
+    # yt-dlp extractor for a supported link, None for anything we don't serve
+    cleaned = urlsplit(clean_url(url))
+    site = HOST_ALIASES.get(cleaned.netloc)
+    target = cleaned.netloc + cleaned.path
+    for pattern, ie_key in EXTRACTOR_ROUTES.get(site, ()):
+        if pattern.search(target):
+            return ie_key
+    return None
+
+
+def canonical_key(url: str) -> str:
+    key = media_key(url)
+    return str(key) if key is not None else f"url:{clean_url(url)}"
+
+
+def url_expiry(url: str) -> Optional[float]:
+    # Unix time at which a signed CDN URL stops working, if it says so:
+    # Instagram/Facebook use hex "oe", YouTube (googlevideo) uses "expire"
+    parts = urlsplit(url)
+    query = {k.lower(): v[0] for k, v in parse_qs(parts.query).items()}
+    try:
+        if "oe" in query:
+            return float(int(query["oe"], 16))
+        if "expire" in query:
+            return float(query["expire"])
+        if "expires" in query:
+            return float(query["expires"])
+        if "x-amz-expires" in query and "x-amz-date" in query:
+            signed = calendar.timegm(time.strptime(query["x-amz-date"], "%Y%m%dT%H%M%SZ"))
+            return signed + float(query["x-amz-expires"])
+    except ValueError:
+        return None
+    # YouTube sometimes moves its parameters into the path: /expire/1700000000/
+    segments = parts.path.split("/")
+    if "expire" in segments:
+        index = segments.index("expire")
+        if index + 1 < len(segments) and segments[index + 1].isdigit():
+            return float(segments[index + 1])
+    return None